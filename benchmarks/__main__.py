@@ -0,0 +1,57 @@
+import argparse
+import asyncio
+import sys
+
+
+async def bench(names: list[str], **options):
+    from . import bench
+    await bench.run(names, **{k: v for k, v in options.items() if v is not None})
+
+async def loadtest(**options):
+    from . import loadtest
+    await loadtest.run(**options)
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+
+    bench_parser = subparsers.add_parser('bench', help='Run backend benchmarks')
+    bench_parser.add_argument('names', nargs='*', help='Benchmarks to run (default: all)')
+    bench_parser.add_argument('--rtt', type=float, default=0.001, help='Simulated database round trip in seconds')
+    bench_parser.add_argument('--questions', type=int, default=1000)
+    bench_parser.add_argument('--rows', type=int, default=None, help='Result rows per query (default: per benchmark)')
+    bench_parser.add_argument('--repeat', type=int, default=None, help='Calls per case (default: per benchmark)')
+    bench_parser.add_argument('--live', action='store_true', default=False,
+                              help='Also measure against the configured database where supported')
+    bench_parser.add_argument('--store', default='.benchmarks', help='Directory for saved results, empty to disable')
+
+    load_parser = subparsers.add_parser('loadtest', help='Load test /search against fake LLM, embedding and database backends')
+    load_parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[50, 200, 500])
+    load_parser.add_argument('-n', '--requests', type=int, default=500, help='Requests per concurrency level')
+    load_parser.add_argument('--questions', type=int, default=100, help='Questions in the fake expertise')
+    load_parser.add_argument('--miss-rate', type=float, default=0.1, help='Share of unknown questions, served by the fallback')
+    load_parser.add_argument('--chat-latency', type=float, default=0.8, help='Median chat completion latency in seconds')
+    load_parser.add_argument('--embedding-latency', type=float, default=0.05, help='Median embedding latency in seconds')
+    load_parser.add_argument('--db-latency', type=float, default=0.005, help='Median database round trip in seconds')
+    load_parser.add_argument('--sigma', type=float, default=0.5, help='Log-normal spread of the latencies')
+    load_parser.add_argument('--error-rate', type=float, default=0.01, help='Share of failing LLM and embedding calls')
+    load_parser.add_argument('--pool-size', type=int, default=100, help='Concurrent transactions per fake driver')
+    load_parser.add_argument('--cache', action='store_true', default=False, help='Keep the answer, query, explain, parameter and embedding caches enabled')
+    return parser
+
+def main(args=sys.argv[1:]):
+    commands = {
+        'bench': bench,
+        'loadtest': loadtest,
+    }
+    p_args = get_parser().parse_args(args=args)
+    if getattr(p_args, 'command', None) is None:
+        get_parser().print_help()
+        sys.exit(1)
+
+    kwargs = dict(p_args._get_kwargs())
+    f = commands[kwargs.pop('command')]
+    asyncio.run(f(**kwargs))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+from ragnroll.backend import model
+from ragnroll.backend import ingest
+from ragnroll.backend import cypher
+from ragnroll.backend.util import log
+from . import fakes
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import subprocess
+import time
+import typing
+
+BenchmarkFunction = typing.Callable[..., typing.Awaitable[dict[str, dict]]]
+
+BENCHMARKS: dict[str, BenchmarkFunction] = {}
+
+
+def benchmark(name: str):
+    def decorator(func: BenchmarkFunction) -> BenchmarkFunction:
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+class RecordingTransaction(object):
+    """Stand-in for neo4j.AsyncTransaction that records statements and simulates a round trip"""
+
+    def __init__(self, rtt: float = 0.0) -> None:
+        self.rtt = rtt
+        self.statements: list[tuple[str, dict]] = []
+
+    async def run(self, query: str, parameters: typing.Optional[dict] = None, **kwargs):
+        self.statements.append((query, parameters or kwargs))
+        await asyncio.sleep(self.rtt)
+
+
+def sample_expertise(questions: int = 1000, questions_per_pattern: int = 10,
+                     outputs_per_pattern: int = 2, samples_per_output: int = 3) -> model.RAGExpertise:
+    patterns = []
+    for p in range(max(questions // questions_per_pattern, 1)):
+        names = [f'q{i}' for i in range(questions_per_pattern)]
+        patterns.append(model.RAGPattern(
+            name=f'pattern-{p}',
+            questions=[model.RAGQuestion(name=n, question=f'How many items are in group {p} variant {n}?')
+                       for n in names],
+            outputs=[model.RAGOutput(
+                name=f'output-{o}',
+                samples=[model.RAGQuery(
+                    questions=[model.NameReference(name=n) for n in names[s::samples_per_output]],
+                    query=f'MATCH (n:Item {{group: {p}, variant: {s}}}) RETURN count(n) AS total'
+                ) for s in range(samples_per_output)]
+            ) for o in range(outputs_per_pattern)]
+        ))
+    return model.RAGExpertise(kind='RAGExpertise', metadata=model.ConfigMetadata(name='benchmark'),
+                              spec=model.RAGExpertiseSpec(patterns=patterns))
+
+
+def sample_embeddings(config: model.RAGExpertise, dimensions: int = 1536) -> dict[str, list[float]]:
+    rnd = random.Random(0)
+    return {q.question: [rnd.random() for _ in range(dimensions)]
+            for p in config.spec.patterns for q in p.questions}
+
+
+async def _write_per_item(txn: RecordingTransaction, config: model.RAGExpertise,
+                          embeddings: dict[str, list[float]]):
+    # the upload job before the UNWIND writer, statements as it sent them with embeddings computed up front
+    query = '''
+    MATCH (n:_RAGExpertise {name: $name})
+    OPTIONAL MATCH (n)-[]-(p:_RAGPattern)
+    OPTIONAL MATCH (p)-[]-(o:_RAGOutput)
+    OPTIONAL MATCH (o)-[]-(q:_RAGQuery)
+    OPTIONAL MATCH (p)-[]-(k:_RAGQuestion)
+    DETACH DELETE o
+    DETACH DELETE k
+    DETACH DELETE q
+    DETACH DELETE n
+    DETACH DELETE p
+    '''
+    await txn.run(query, parameters={
+        'name': config.metadata.name
+    })
+    query = '''
+    MERGE (n:_RAGExpertise {name: $name})
+    SET n.filesize = $filesize,
+        n.body = $body
+    '''
+    jsondata = config.model_dump_json(indent=4)
+    await txn.run(query=query, parameters={
+        'name': config.metadata.name,
+        'body': jsondata,
+        'filesize': len(jsondata),
+        'filetype': 'application/json'
+    })
+
+    for pattern in config.spec.patterns:
+        query = '''
+            MERGE (n:_RAGExpertise {name: $expertise_name})
+            MERGE (p:_RAGPattern {expertise: $expertise_name, name: $pattern_name})
+            MERGE (n)-[:HAS_PATTERN]-(p)
+        '''
+        await txn.run(query=query, parameters={
+            'expertise_name': config.metadata.name,
+            'pattern_name': pattern.name,
+        })
+        for question in pattern.questions:
+            query = '''
+                MATCH (p:_RAGPattern {expertise: $expertise_name, name: $pattern_name})
+                MERGE (p)-[:HAS_QUESTION]->(k:_RAGQuestion {expertise: $expertise_name, pattern: $pattern_name, name: $question_name, question: $question, language: $language})
+                SET k.embedding = $embedding
+            '''
+            await txn.run(query=query, parameters={
+                'expertise_name': config.metadata.name,
+                'pattern_name': pattern.name,
+                'question_name': question.name,
+                'question': question.question,
+                'language': question.language,
+                'embedding': embeddings[question.question]
+            })
+        for output in pattern.outputs:
+            for sample in output.samples:
+                query = '''
+                    MATCH (p:_RAGPattern {expertise: $expertise_name, name: $pattern_name})
+                    MERGE (o:_RAGOutput {expertise: $expertise_name, pattern: $pattern_name, name: $output_name})
+                    MERGE (o)-[:HAS_QUERY]->(q:_RAGQuery {expertise: $expertise_name, pattern: $pattern_name, output: $output_name, query: $query})
+                    MERGE (p)-[:HAS_OUTPUT]->(o)
+                    SET o.visualization = $visualization
+                    SET o.order = $order
+                '''
+                await txn.run(query=query, parameters={
+                    'expertise_name': config.metadata.name,
+                    'pattern_name': pattern.name,
+                    'output_name': output.name,
+                    'query': sample.query,
+                    'visualization': output.visualization,
+                    'order': output.order
+                })
+                for question in sample.questions:
+                    query = '''
+                        MATCH (question:_RAGQuestion {expertise: $expertise_name, pattern: $pattern_name, name: $question_name})
+                        MATCH (query:_RAGQuery {expertise: $expertise_name, pattern: $pattern_name, output: $output_name, query: $query})
+                        MERGE (query)-[:ANSWERS]->(question)
+                    '''
+                    await txn.run(query=query, parameters={
+                        'expertise_name': config.metadata.name,
+                        'pattern_name': pattern.name,
+                        'question_name': question.name,
+                        'output_name': output.name,
+                        'query': sample.query
+                    })
+
+
+async def _measure(writer: typing.Callable[[RecordingTransaction], typing.Awaitable], rtt: float) -> dict:
+    txn = RecordingTransaction(rtt=rtt)
+    start = time.perf_counter()
+    await writer(txn)
+    return {'round_trips': len(txn.statements), 'seconds': time.perf_counter() - start}
+
+
+@benchmark('ingest')
+async def bench_ingest(rtt: float = 0.001, questions: int = 1000, **kwargs) -> dict[str, dict]:
+    config = sample_expertise(questions=questions)
+    embeddings = sample_embeddings(config)
+    flat = ingest.flatten_expertise(config)
+    full_diff = ingest.diff_expertise(ingest.empty_expertise(), flat)
+
+    edited = config.model_copy(deep=True)
+    edited.spec.patterns[0].outputs[0].samples[0].query += ' LIMIT 10'
+    edited.spec.patterns[0].questions[0].question += ' today'
+    edit_diff = ingest.diff_expertise(flat, ingest.flatten_expertise(edited))
+    edit_embeddings = ingest.pending_embeddings(flat, edit_diff)
+
+    edit_vectors = sample_embeddings(edited)
+
+    per_item = await _measure(lambda txn: _write_per_item(txn, config, embeddings), rtt)
+    full = await _measure(lambda txn: ingest.write_expertise(txn, config, full_diff, embeddings), rtt)
+    full['embeddings'] = len(ingest.pending_embeddings(ingest.empty_expertise(), full_diff))
+    incremental = await _measure(lambda txn: ingest.write_expertise(
+        txn, edited, edit_diff, {t: edit_vectors[t] for t in edit_embeddings}), rtt)
+    incremental['embeddings'] = len(edit_embeddings)
+    incremental['rows'] = sum(len(v) for v in edit_diff['upsert'].values()) + \
+                          sum(len(v) for v in edit_diff['delete'].values())
+    return {
+        'per-item': per_item,
+        'unwind': full,
+        'unwind-incremental': incremental,
+    }
+
+
+def random_query(rnd: random.Random) -> str:
+    def literal():
+        words = ['limit', 'RETURN', 'union', '{', ')', '999', "\\'", 'n']
+        return "'" + ' '.join(rnd.choice(words) for _ in range(rnd.randint(0, 5))) + "'"
+
+    def branch():
+        parts = [f'MATCH (n:Item {{name: {literal()}}})']
+        if rnd.random() < 0.4:
+            parts.append(f'CALL {{ WITH n MATCH (n)--(m) RETURN m LIMIT {rnd.randint(1, 5000)} }}')
+        if rnd.random() < 0.3:
+            parts.append(f'WITH n LIMIT {rnd.randint(1, 5000)}')
+        parts.append(rnd.choice(['RETURN n', 'RETURN n.limit AS limit', 'RETURN DISTINCT n.name AS name',
+                                 'RETURN count(*) AS total']))
+        if rnd.random() < 0.3:
+            parts.append('ORDER BY n.name DESC')
+        if rnd.random() < 0.2:
+            parts.append(f'SKIP {rnd.randint(0, 10)}')
+        if rnd.random() < 0.6:
+            parts.append('LIMIT ' + rnd.choice([str(rnd.randint(0, 5000)), '$limit', 'toInteger($x) + 1']))
+        return rnd.choice([' ', '\n']).join(parts)
+
+    query = branch()
+    while rnd.random() < 0.2:
+        query += rnd.choice([' UNION ', ' UNION ALL ']) + branch()
+    if rnd.random() < 0.2:
+        query += ' // LIMIT 1000'
+    if rnd.random() < 0.3:
+        query += ';'
+    return query
+
+
+@benchmark('enforce-limit')
+async def bench_enforce_limit(cases: int = 2000, result_limit: int = 20, **kwargs) -> dict[str, dict]:
+    # correctness of the rewrite is covered by tests/test_cypher.py
+    rnd = random.Random(0)
+    queries = [random_query(rnd) for _ in range(cases)]
+    start = time.perf_counter()
+    for q in queries:
+        cypher.enforce_limit(q, result_limit)
+    elapsed = time.perf_counter() - start
+    return {'enforce_limit': {'cases': cases, 'seconds': elapsed, 'us_per_query': elapsed / cases * 1e6}}
+
+
+def _timed(func: typing.Callable[[], typing.Any], repeat: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - start
+    return {'calls': repeat, 'seconds': elapsed, 'us_per_call': elapsed / repeat * 1e6}
+
+
+async def _atimed(func: typing.Callable[[], typing.Awaitable], repeat: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await func()
+    elapsed = time.perf_counter() - start
+    return {'calls': repeat, 'seconds': elapsed, 'us_per_call': elapsed / repeat * 1e6}
+
+
+def sample_rows(rows: int) -> list[dict]:
+    import neo4j.time
+    import neo4j.spatial
+    rnd = random.Random(0)
+    return [{
+        'name': f'item-{i}',
+        # non-ASCII text is escaped by the json module and written as UTF-8 by orjson
+        'label': f'Élément {i} — 项目',
+        'total': rnd.randint(0, 10 ** 6),
+        'ratio': rnd.random(),
+        'tags': [f'tag-{rnd.randint(0, 50)}' for _ in range(3)],
+        'created': neo4j.time.Date(2024, 1 + i % 12, 1 + i % 28),
+        'updated': neo4j.time.DateTime(2024, 1 + i % 12, 1 + i % 28, i % 24, i % 60, 0),
+        'owner': {'name': f'owner-{i % 100}', 'active': i % 2 == 0},
+        'location': neo4j.spatial.WGS84Point((rnd.uniform(-180, 180), rnd.uniform(-90, 90))),
+        'elapsed': neo4j.time.Duration(days=i % 30, seconds=i % 3600),
+    } for i in range(rows)]
+
+
+def offline_pipeline(questions: int = 100, rows: int = 20,
+                     chat_latency: typing.Optional[fakes.Latency] = None,
+                     embedding_latency: typing.Optional[fakes.Latency] = None,
+                     db_latency: typing.Optional[fakes.Latency] = None, pool_size: int = 100):
+    """Install fake models and driver answering for sample_expertise(questions)"""
+    embeddings = fakes.FakeEmbeddings(latency=embedding_latency)
+    config = sample_expertise(questions=questions)
+    graph = fakes.FakeGraph(config, embeddings, rows=rows)
+    fakes.install(chat=fakes.FakeChatModel(latency=chat_latency), embeddings=embeddings, handler=graph,
+                  latency=db_latency, pool_size=pool_size)
+    # per call progress logging would dominate the measurements
+    log.setLevel(logging.WARNING)
+    return config, embeddings, graph
+
+
+@benchmark('jsonify')
+async def bench_jsonify(rows: int = 10000, **kwargs) -> dict[str, dict]:
+    fakes.install()
+    from ragnroll.backend import rag, serialize
+    data = sample_rows(rows)
+    driver = fakes.FakeDriver(lambda query, parameters: data)
+
+    async def read():
+        async with driver.session() as session:
+            return await session.execute_read(rag.read_result, 'MATCH (n) RETURN n', max_rows=rows,
+                                              max_bytes=2 ** 40)
+
+    return {
+        # the json module output the API returned before orjson, escaped and with ', ' and ': ' separators
+        'stdlib': dict(_timed(lambda: json.dumps(data, default=serialize.default), 5), rows=rows,
+                       bytes=len(json.dumps(data, default=serialize.default).encode('utf-8'))),
+        'compact': dict(_timed(lambda: rag.jsonify_result(data), 5), rows=rows,
+                        bytes=len(rag.jsonify_result(data).encode('utf-8'))),
+        'indented': dict(_timed(lambda: rag.jsonify_result(data, pretty=True), 5), rows=rows),
+        # rows are encoded once while reading, the compact document is joined from them
+        'read-result': dict(await _atimed(read, 5), rows=rows),
+    }
+
+
+@benchmark('find-queries')
+async def bench_find_queries(repeat: int = 1000, **kwargs) -> dict[str, dict]:
+    config, embeddings, graph = offline_pipeline()
+    from ragnroll.backend import rag
+    driver = fakes.FakeDriver(graph)
+    embedding = embeddings.vector(config.spec.patterns[0].questions[0].question)
+
+    async def find():
+        async with driver.session() as session:
+            return await rag.find_queries(session, embedding)
+
+    outputs = await find()
+    assert outputs, 'sample question did not match its own expertise'
+    return {'aggregate': dict(await _atimed(find, repeat), outputs=len(outputs),
+                              rows=len(graph.search(embedding, 5, 0.9)))}
+
+
+@benchmark('fetch-output')
+async def bench_fetch_output(repeat: int = 200, rows: int = 20, **kwargs) -> dict[str, dict]:
+    config, embeddings, graph = offline_pipeline(rows=rows)
+    from ragnroll.backend import rag
+    driver = fakes.FakeDriver(graph)
+    sample = config.spec.patterns[0].outputs[0].samples[0]
+    question = config.spec.patterns[0].questions[0].question
+    result = {}
+    for visualization in model.VisualizationType:
+        output = rag.SearchOutput(visualization=visualization, queries=[
+            rag.OutputQuery(question=question, query=sample.query, score=1.0)])
+        # the first call fills the query cache, the rest measure execution and post-processing
+        assert await rag.fetch_output(output, question, driver) is not None, f'no {visualization} output'
+        result[visualization.value] = dict(
+            await _atimed(lambda: rag.fetch_output(output, question, driver), repeat), rows=rows)
+    return result
+
+
+@benchmark('flatten')
+async def bench_flatten(questions: int = 1000, repeat: int = 20, **kwargs) -> dict[str, dict]:
+    config = sample_expertise(questions=questions)
+    flat = ingest.flatten_expertise(config)
+    edited = config.model_copy(deep=True)
+    edited.spec.patterns[0].questions[0].question += ' today'
+    edited_flat = ingest.flatten_expertise(edited)
+    return {
+        'flatten': dict(_timed(lambda: ingest.flatten_expertise(config), repeat), questions=questions),
+        'diff': dict(_timed(lambda: ingest.diff_expertise(flat, edited_flat), repeat), questions=questions),
+    }
+
+
+@benchmark('vector-index')
+async def bench_vector_index(questions: int = 1000, repeat: int = 200, live: bool = False,
+                             **kwargs) -> dict[str, dict]:
+    import numpy
+    from ragnroll.backend.vector import QuestionIndex
+    result = {}
+    rng = numpy.random.default_rng(0)
+    for size in (questions, questions * 10):
+        vectors = rng.standard_normal((size, 1536)).astype(numpy.float32)
+        index = QuestionIndex()
+        start = time.perf_counter()
+        index.build([(str(i), v) for i, v in enumerate(vectors)])
+        build = time.perf_counter() - start
+        query = (vectors[0] + rng.standard_normal(1536).astype(numpy.float32) * 0.1).tolist()
+        assert index.search(query, 5, 0.9)[0]['id'] == '0', 'nearest question not found'
+        result[f'local-{size}'] = dict(_timed(lambda: index.search(query, 5, 0.9), repeat),
+                                       questions=size, build_seconds=build)
+    if live:
+        # find_queries end to end against the configured database, both index modes
+        from ragnroll.backend import db, rag, settings
+        from ragnroll.backend.vector import question_index
+        mode = settings.VECTOR_INDEX
+        try:
+            async with db.borrow(None) as driver:
+                async with driver.session() as session:
+                    await question_index.load(session)
+                    if not question_index.ids:
+                        raise RuntimeError('No question embeddings stored, upload an expertise first')
+                    embedding = question_index.matrix[0].tolist()
+                    for name in ('neo4j', 'local'):
+                        settings.VECTOR_INDEX = name
+                        result[f'find-queries-{name}'] = dict(
+                            await _atimed(lambda: rag.find_queries(session, embedding), repeat),
+                            questions=len(question_index.ids))
+        finally:
+            settings.VECTOR_INDEX = mode
+            await db.registry.close()
+    return result
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _previous(store: str, current: str) -> typing.Optional[dict]:
+    paths = [os.path.join(store, f) for f in os.listdir(store)
+             if f.endswith('.json') and os.path.join(store, f) != current]
+    if not paths:
+        return None
+    with open(max(paths, key=os.path.getmtime)) as f:
+        return json.load(f)
+
+
+def _change(value: typing.Any, previous: typing.Any) -> str:
+    if not isinstance(value, float) or not isinstance(previous, (int, float)) or not previous:
+        return ''
+    return f' ({(value - previous) / previous:+.1%})'
+
+
+async def run(names: typing.Optional[list[str]] = None, store: typing.Optional[str] = '.benchmarks', **options):
+    """Run benchmarks, save them as <store>/<commit>.json and compare with the previous saved run"""
+    path = os.path.join(store, f'{_commit()}.json') if store else None
+    previous = {}
+    if path and os.path.isdir(store):
+        previous = (_previous(store, path) or {}).get('results', {})
+    results = {}
+    for name in names or list(BENCHMARKS.keys()):
+        results[name] = result = await BENCHMARKS[name](**options)
+        print(f'> {name}')
+        for case, metrics in result.items():
+            before = previous.get(name, {}).get(case, {})
+            print(f'  {case:<24}' + '  '.join(
+                (f'{k}={v:.6f}' if isinstance(v, float) else f'{k}={v}') + _change(v, before.get(k))
+                for k, v in metrics.items()))
+    if path:
+        os.makedirs(store, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'commit': _commit(), 'created': datetime.datetime.now().isoformat(),
+                       'options': options, 'results': results}, f, indent=2)
+        print(f'> Saved {path}')
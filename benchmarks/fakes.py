@@ -0,0 +1,278 @@
+from ragnroll.backend import model
+from ragnroll.backend import ingest
+import asyncio
+import hashlib
+import json
+import random
+import re
+import typing
+import numpy
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeServiceError(Exception):
+    pass
+
+
+class Latency(object):
+    """Log-normal latency around a median, with an independent failure rate"""
+
+    def __init__(self, median: float = 0.0, sigma: float = 0.5, error_rate: float = 0.0, seed: int = 0) -> None:
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.random.lognormvariate(0, self.sigma) * self.median
+
+    async def wait(self, name: str = 'service'):
+        delay = self.sample()
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise FakeServiceError(f'Injected {name} failure')
+
+
+QUERY_LINE = re.compile(r'^\s*Query: (.+?)\.?\s*$', re.M)
+PARAMETER_LINE = re.compile(r'^\s*- (\w+) \((\w+)\)', re.M)
+PARAMETER_VALUES = {'string': 'Item 1', 'integer': 1, 'float': 1.0, 'boolean': True, 'list': ['Item 1']}
+FALLBACK_QUERY = 'MATCH (n) RETURN n.name AS name, count(*) AS total'
+
+
+def respond(prompt: str) -> str:
+    """Deterministic reply for each of the prompts used by the RAG pipeline"""
+    if 'Parameters:' in prompt:
+        return json.dumps({name: PARAMETER_VALUES.get(kind, 'Item 1')
+                           for name, kind in PARAMETER_LINE.findall(prompt)})
+    queries = QUERY_LINE.findall(prompt)
+    if queries:
+        # sample based generation and the corrector both echo the first query they are shown
+        return queries[0]
+    if 'Schema:' in prompt:
+        return FALLBACK_QUERY
+    digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8]
+    return f'There are {len(prompt.splitlines())} facts in the provided context ({digest}).'
+
+
+class FakeChatModel(BaseChatModel):
+    latency: typing.Any = None
+    chunk_size: int = 4
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-chat'
+
+    def _reply(self, messages: list[BaseMessage]) -> str:
+        return respond('\n'.join(str(m.content) for m in messages))
+
+    def _generate(self, messages: list[BaseMessage], stop: typing.Optional[list[str]] = None,
+                  run_manager: typing.Optional[CallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: typing.Optional[list[str]] = None,
+                         run_manager: typing.Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        if self.latency:
+            await self.latency.wait('chat')
+        return self._generate(messages, stop=stop, **kwargs)
+
+    async def _astream(self, messages: list[BaseMessage], stop: typing.Optional[list[str]] = None,
+                       run_manager: typing.Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs) -> typing.AsyncIterator[ChatGenerationChunk]:
+        if self.latency:
+            await self.latency.wait('chat')
+        words = re.findall(r'\S+\s*', self._reply(messages))
+        for i in range(0, len(words), self.chunk_size):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=''.join(words[i:i + self.chunk_size])))
+
+
+class FakeEmbeddings(Embeddings):
+    """Unit vectors seeded from the text hash, identical texts always embed identically"""
+
+    def __init__(self, dimensions: int = 1536, latency: typing.Optional[Latency] = None) -> None:
+        self.dimensions = dimensions
+        self.latency = latency
+        self.model = f'fake-{dimensions}'
+
+    def vector(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        v = numpy.random.default_rng(seed).standard_normal(self.dimensions)
+        return (v / numpy.linalg.norm(v)).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.vector(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.latency:
+            await self.latency.wait('embedding')
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        if self.latency:
+            await self.latency.wait('embedding')
+        return self.embed_query(text)
+
+
+class FakeRecord(dict):
+
+    def data(self) -> dict:
+        return dict(self)
+
+
+class FakeResult(object):
+
+    def __init__(self, records: list[dict]) -> None:
+        self.records = [FakeRecord(r) for r in records]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for r in self.records:
+            yield r
+
+    def keys(self) -> list[str]:
+        return list(self.records[0].keys()) if self.records else []
+
+    async def data(self) -> list[dict]:
+        return [r.data() for r in self.records]
+
+    async def consume(self):
+        self.records = []
+
+
+Handler = typing.Callable[[str, dict], list[dict]]
+
+
+class FakeTransaction(object):
+
+    def __init__(self, handler: Handler, latency: typing.Optional[Latency] = None) -> None:
+        self.handler = handler
+        self.latency = latency
+        self.statements = 0
+
+    async def run(self, query: str, parameters: typing.Optional[dict] = None, **kwargs) -> FakeResult:
+        self.statements += 1
+        if self.latency:
+            await self.latency.wait('database')
+        return FakeResult(self.handler(query, parameters or kwargs))
+
+
+class FakeSession(object):
+
+    def __init__(self, driver: 'FakeDriver') -> None:
+        self.driver = driver
+
+    async def __aenter__(self) -> 'FakeSession':
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _execute(self, work: typing.Callable, *args, **kwargs):
+        if self.driver.pool.locked():
+            self.driver.pool_waits += 1
+        async with self.driver.pool:
+            return await work(FakeTransaction(self.driver.handler, self.driver.latency), *args, **kwargs)
+
+    execute_read = _execute
+    execute_write = _execute
+
+    async def run(self, query: str, parameters: typing.Optional[dict] = None, **kwargs) -> FakeResult:
+        return await self._execute(lambda txn: txn.run(query, parameters, **kwargs))
+
+    async def close(self):
+        pass
+
+
+class FakeDriver(object):
+    """In-memory neo4j.AsyncDriver stand-in, pool size bounds concurrent transactions"""
+
+    def __init__(self, handler: Handler, latency: typing.Optional[Latency] = None, pool_size: int = 100) -> None:
+        self.handler = handler
+        self.latency = latency
+        self.pool = asyncio.Semaphore(pool_size)
+        self.pool_waits = 0
+
+    def session(self, **kwargs) -> FakeSession:
+        return FakeSession(self)
+
+    async def verify_connectivity(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class FakeGraph(object):
+    """Answers the vector lookup from an expertise config, and any other query with generated rows"""
+
+    def __init__(self, config: model.RAGExpertise, embeddings: FakeEmbeddings, rows: int = 20) -> None:
+        self.rows = rows
+        self.matches: list[list[dict]] = []
+        vectors = []
+        for pattern in config.spec.patterns:
+            for question in pattern.questions:
+                matches = []
+                for output in pattern.outputs:
+                    for sample in output.samples:
+                        if question.name in [q.name for q in sample.questions]:
+                            matches.append({
+                                'query': {'query': sample.query, 'parameters': json.dumps(
+                                    [p.model_dump(mode='json', exclude_none=True)
+                                     for p in ingest.sample_parameters(sample)])},
+                                'question': {'question': question.question, 'name': question.name,
+                                             'language': question.language.value},
+                                'output': {'name': output.name, 'visualization': output.visualization.value,
+                                           'order': output.order, 'answer_template': output.answer_template,
+                                           'answer_language': output.answer_language.value},
+                            })
+                self.matches.append(matches)
+                vectors.append(embeddings.vector(question.question))
+        self.vectors = numpy.array(vectors, dtype=numpy.float32).reshape(len(vectors), embeddings.dimensions)
+
+    def search(self, embedding: list[float], count: int, min_score: float) -> list[dict]:
+        # neo4j reports cosine similarity rescaled to [0, 1]
+        scores = (1 + self.vectors @ numpy.asarray(embedding, dtype=numpy.float32)) / 2
+        result = []
+        for i in numpy.argsort(-scores)[:count]:
+            if scores[i] > min_score:
+                result.extend(dict(m, score=float(scores[i])) for m in self.matches[i])
+        return result
+
+    def __call__(self, query: str, parameters: dict) -> list[dict]:
+        if 'MATCH (k:_RAGQuestion)' in query:
+            return [{'id': str(i), 'embedding': v.tolist()} for i, v in enumerate(self.vectors)]
+        if 'UNWIND $matches' in query:
+            return [dict(m, score=match['score'], i=match['index']) for match in parameters['matches']
+                    for m in self.matches[int(match['id'])]]
+        if 'db.index.vector.queryNodes' in query:
+            return [dict(m, i=i) for i, embedding in enumerate(parameters['embeddings'])
+                    for m in self.search(embedding, parameters.get('count', 5), parameters.get('min_score', 0.0))]
+        if query.lstrip().upper().startswith('EXPLAIN') or 'apoc.meta.data' in query \
+                or 'db.index.fulltext.queryNodes' in query:
+            return []
+        return [{'name': f'item-{i}', 'total': i} for i in range(self.rows)]
+
+
+def install(chat: typing.Optional[BaseChatModel] = None, embeddings: typing.Optional[FakeEmbeddings] = None,
+            handler: typing.Optional[Handler] = None, latency: typing.Optional[Latency] = None,
+            pool_size: int = 100):
+    """Swap the module level models and the driver factory for fakes"""
+    from ragnroll.backend import langchain, rag, db
+    if chat is not None:
+        langchain.chat_model = rag.chat_model = chat
+    if embeddings is not None:
+        langchain.embeddings_model = embeddings
+    if handler is not None:
+        db.registry.driver_factory = lambda auth=None, **params: FakeDriver(handler, latency, pool_size)
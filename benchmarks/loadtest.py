@@ -0,0 +1,143 @@
+from ragnroll.backend import settings
+from ragnroll.backend import db
+from ragnroll.backend.scheduler import llm_scheduler
+from . import fakes
+from .bench import offline_pipeline
+import asyncio
+import collections
+import random
+import time
+import typing
+import httpx
+import numpy
+
+
+class LoopLagMonitor(object):
+    """Measures how late a periodic timer fires, i.e. how long the event loop was blocked"""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.samples: list[float] = []
+        self.task: typing.Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(time.perf_counter() - start - self.interval, 0.0))
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    p50, p95, p99 = numpy.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(max(values))}
+
+
+def disable_caches():
+    # every request should pay for the full pipeline, only the periodically refreshed schema stays cached
+    from ragnroll.backend import rag, langchain
+    settings.SEMANTIC_CACHE_ENABLED = False
+    for c in (rag.cypher_cache, rag.explain_cache, rag.parameter_cache, langchain.embedding_cache.memory):
+        c.maxsize = 0
+        c.clear()
+    langchain.embedding_cache.store = None
+
+
+def active_caches() -> list[str]:
+    from ragnroll.backend import rag, langchain
+    caches = {'answer': settings.SEMANTIC_CACHE_ENABLED,
+              'cypher': rag.cypher_cache.maxsize > 0,
+              'explain': rag.explain_cache.maxsize > 0,
+              'parameter': rag.parameter_cache.maxsize > 0,
+              'embedding': langchain.embedding_cache.memory.maxsize > 0,
+              'embedding_disk': langchain.embedding_cache.store is not None,
+              'schema': True}
+    return [name for name, active in caches.items() if active]
+
+
+async def run_level(client: httpx.AsyncClient, questions: list[str], concurrency: int, requests: int) -> dict:
+    latencies: list[float] = []
+    statuses: collections.Counter = collections.Counter()
+    counter = iter(range(requests))
+    rnd = random.Random(concurrency)
+
+    async def worker():
+        for _ in counter:
+            start = time.perf_counter()
+            try:
+                response = await client.get('/search', params={'question': rnd.choice(questions)})
+                statuses[response.status_code] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - start)
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    waits = llm_scheduler.waits
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        monitor.stop()
+    elapsed = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'seconds': elapsed,
+        'throughput': requests / elapsed,
+        'latency': percentiles(latencies),
+        'loop_lag': percentiles(monitor.samples),
+        'statuses': dict(statuses),
+        'llm_waits': llm_scheduler.waits - waits,
+        'llm_wait_max': llm_scheduler.wait_seconds_max,
+        'pool_waits': sum(getattr(e.driver, 'pool_waits', 0) for e in db.registry.entries.values()),
+    }
+
+
+def report(result: dict):
+    latency, lag = result['latency'], result['loop_lag']
+    print(f"> concurrency={result['concurrency']} requests={result['requests']} "
+          f"seconds={result['seconds']:.2f} throughput={result['throughput']:.1f}/s")
+    print('  latency   ' + '  '.join(f'{k}={v * 1000:.1f}ms' for k, v in latency.items()))
+    print('  loop lag  ' + '  '.join(f'{k}={v * 1000:.1f}ms' for k, v in lag.items()))
+    print(f"  statuses  {result['statuses']}")
+    print(f"  waits     llm={result['llm_waits']} llm_max={result['llm_wait_max'] * 1000:.1f}ms "
+          f"driver_pool={result['pool_waits']}")
+
+
+async def run(concurrency: list[int], requests: int = 500, questions: int = 100, miss_rate: float = 0.1,
+              chat_latency: float = 0.8, embedding_latency: float = 0.05, db_latency: float = 0.005,
+              sigma: float = 0.5, error_rate: float = 0.01, pool_size: int = 100, cache: bool = False,
+              **kwargs) -> list[dict]:
+    """Drive /search in process through the ASGI app with fake LLM, embedding and database backends"""
+    config, _, _ = offline_pipeline(
+        questions=questions,
+        chat_latency=fakes.Latency(chat_latency, sigma, error_rate, seed=1),
+        embedding_latency=fakes.Latency(embedding_latency, sigma, error_rate, seed=2),
+        db_latency=fakes.Latency(db_latency, sigma, 0.0, seed=3),
+        pool_size=pool_size)
+    if not cache:
+        disable_caches()
+    known = [q.question for p in config.spec.patterns for q in p.questions]
+    unknown = [f'Who maintains component {i} of the legacy system?' for i in range(max(int(len(known) * miss_rate), 1))]
+    mix = known + (unknown if miss_rate > 0 else [])
+    print(f"> active caches: {', '.join(active_caches())}")
+
+    from ragnroll import app as reflex_app
+    transport = httpx.ASGITransport(app=reflex_app.api, raise_app_exceptions=False)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=None) as client:
+        for level in concurrency:
+            result = await run_level(client, mix, level, requests)
+            report(result)
+            results.append(result)
+    await db.registry.close()
+    return results
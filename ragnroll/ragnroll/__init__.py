@@ -10,6 +10,7 @@ log = logging.getLogger("ragnroll")
 def load():
     from .backend import router 
     from .backend.endpoint import search 
+    from .backend.endpoint import stats
     from .backend.endpoint.resource import expertise 
     from .page import search
     from .page import expertise
@@ -0,0 +1,63 @@
+from . import settings
+from . import model
+from .context import cell
+from .util import cprint
+import typing
+
+SCALARS = (str, int, float, bool)
+
+
+def is_scalar(value: typing.Any) -> bool:
+    return value is not None and isinstance(value, SCALARS)
+
+
+def render_template(template: str, data: list[dict]) -> typing.Optional[str]:
+    """One line per row from the output template, None when a row does not fit it"""
+    if not data or len(data) > settings.ANSWER_RULE_MAX_ROWS:
+        return None
+    try:
+        # a missing value renders empty rather than as "None"
+        return '\n'.join(template.format_map({k: '' if v is None else v for k, v in row.items()}) for row in data)
+    except (KeyError, ValueError, TypeError, IndexError) as e:
+        cprint("> Answer template does not fit result", color='red', template=template, error=str(e))
+        return None
+
+
+def render_rule(data: list[dict]) -> typing.Optional[str]:
+    """Restate a single value, a single small record or a short key/value listing"""
+    if not data or len(data) > settings.ANSWER_RULE_MAX_ROWS:
+        return None
+    max_chars = settings.ANSWER_CONTEXT_MAX_CELL
+    fields = list(dict.fromkeys(k for row in data for k in row))
+    if not all(is_scalar(row.get(f)) for row in data for f in fields):
+        return None
+    if len(data) == 1:
+        row = data[0]
+        if len(fields) == 1:
+            return cell(row[fields[0]], max_chars)
+        if len(fields) <= settings.ANSWER_RULE_MAX_FIELDS:
+            return '\n'.join(f'{f}: {cell(row[f], max_chars)}' for f in fields)
+        return None
+    if len(fields) == 2 and all(isinstance(row[fields[0]], str) for row in data):
+        return '\n'.join(f'{cell(row[fields[0]], max_chars)}: {cell(row[fields[1]], max_chars)}' for row in data)
+    return None
+
+
+def render_answer(data: list[dict], template: typing.Optional[str] = None, truncated: bool = False,
+                  language: typing.Optional[model.Language] = None,
+                  answer_language: model.Language = model.Language.en_US
+                  ) -> typing.Optional[tuple[str, model.AnswerPath]]:
+    """Answer text and how it was produced, None when the result needs the LLM to be put into words"""
+    if language is not None and language != answer_language:
+        # templates and rule labels would answer in the wrong language
+        return None
+    if template:
+        text = render_template(template, data)
+        if text is not None:
+            return text, model.AnswerPath.TEMPLATE
+    # a cut result can not be restated as complete
+    if settings.ANSWER_RULES_ENABLED and not truncated:
+        text = render_rule(data)
+        if text is not None:
+            return text, model.AnswerPath.RULE
+    return None
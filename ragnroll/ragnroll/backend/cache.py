@@ -0,0 +1,232 @@
+import array
+import asyncio
+import collections
+import re
+import sqlite3
+import threading
+import time
+import typing
+import numpy
+
+K = typing.TypeVar('K')
+V = typing.TypeVar('V')
+
+MISSING = object()
+
+
+class LRUCache(typing.Generic[K, V]):
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self.data: collections.OrderedDict[K, V] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K, default: typing.Any = None) -> typing.Any:
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: K, value: V):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self.data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def normalize_question(text: str) -> str:
+    text = re.sub(r'\s+', ' ', text.strip().casefold())
+    return text.rstrip('?!. ')
+
+
+class SQLiteVectorStore(object):
+    """Persistent key -> float32 vector store backed by a SQLite file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS embedding (key TEXT PRIMARY KEY, vector BLOB)')
+            self.conn.commit()
+
+    def get_many(self, keys: list[str]) -> dict[str, array.array]:
+        result = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.conn.execute(
+                    'SELECT key, vector FROM embedding WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk)
+                for key, blob in rows:
+                    result[key] = array.array('f', blob)
+        return result
+
+    def set_many(self, items: dict[str, array.array]):
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO embedding (key, vector) VALUES (?, ?)',
+                                  [(k, array.array('f', v).tobytes()) for k, v in items.items()])
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class EmbeddingCache(object):
+    """Vectors are held as float32 arrays, callers convert them to lists where a client needs one"""
+
+    def __init__(self, model_name: str, maxsize: int = 4096,
+                 path: typing.Optional[str] = None) -> None:
+        self.model_name = model_name
+        self.memory: LRUCache[str, array.array] = LRUCache(maxsize=maxsize)
+        self.store = SQLiteVectorStore(path) if path else None
+        self.disk_hits = 0
+
+    def key(self, text: str) -> str:
+        return f'{self.model_name}:{normalize_question(text)}'
+
+    async def get_many(self, texts: list[str]) -> dict[str, array.array]:
+        found = {}
+        missing = []
+        for text in texts:
+            vector = self.memory.get(self.key(text))
+            if vector is None:
+                missing.append(text)
+            else:
+                found[text] = vector
+        if missing and self.store is not None:
+            keys = {self.key(t): t for t in missing}
+            stored = await asyncio.to_thread(self.store.get_many, list(keys.keys()))
+            for key, vector in stored.items():
+                self.memory.set(key, vector)
+                found[keys[key]] = vector
+                self.disk_hits += 1
+        return found
+
+    async def set_many(self, items: dict[str, list[float]]) -> dict[str, array.array]:
+        vectors = {t: array.array('f', v) for t, v in items.items()}
+        entries = {self.key(t): v for t, v in vectors.items()}
+        for key, vector in entries.items():
+            self.memory.set(key, vector)
+        if entries and self.store is not None:
+            await asyncio.to_thread(self.store.set_many, entries)
+        return vectors
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        stats['misses'] = stats['misses'] - self.disk_hits
+        stats['persistent'] = self.store is not None
+        return stats
+
+
+class SemanticCache(typing.Generic[V]):
+    """Cache values by embedding similarity, partitioned by namespace"""
+
+    def __init__(self, maxsize: int = 512, threshold: float = 0.97, ttl: float = 600.0) -> None:
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.entries: collections.OrderedDict[int, tuple[str, numpy.ndarray, V, float, typing.Hashable]] = \
+            collections.OrderedDict()
+        self.matrix: dict[str, tuple[list[int], numpy.ndarray]] = {}
+        self.counter = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _matrix(self, namespace: str) -> tuple[list[int], typing.Optional[numpy.ndarray]]:
+        if namespace not in self.matrix:
+            ids = [i for i, e in self.entries.items() if e[0] == namespace]
+            if not ids:
+                return [], None
+            self.matrix[namespace] = (ids, numpy.stack([self.entries[i][1] for i in ids]))
+        return self.matrix[namespace]
+
+    def get(self, namespace: str, embedding: list[float], key: typing.Hashable = None) -> typing.Optional[V]:
+        """Closest entry above the threshold whose key matches, similar questions about other values miss"""
+        ids, matrix = self._matrix(namespace)
+        if matrix is not None:
+            vector = numpy.asarray(embedding, dtype=numpy.float32)
+            scores = matrix @ (vector / (numpy.linalg.norm(vector) or 1.0))
+            now = time.monotonic()
+            expired = []
+            found = None
+            for i in numpy.argsort(-scores):
+                if scores[i] < self.threshold:
+                    break
+                entry = self.entries[ids[i]]
+                if entry[3] <= now:
+                    expired.append(ids[i])
+                elif entry[4] == key:
+                    found = ids[i]
+                    break
+            for entry_id in expired:
+                self._remove(entry_id)
+            if found is not None:
+                self.entries.move_to_end(found)
+                self.hits += 1
+                return self.entries[found][2]
+        self.misses += 1
+        return None
+
+    def set(self, namespace: str, embedding: list[float], value: V, key: typing.Hashable = None):
+        vector = numpy.asarray(embedding, dtype=numpy.float32)
+        vector = vector / (numpy.linalg.norm(vector) or 1.0)
+        self.counter += 1
+        self.entries[self.counter] = (namespace, vector, value, time.monotonic() + self.ttl, key)
+        self.matrix.pop(namespace, None)
+        while len(self.entries) > self.maxsize:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, entry_id: int):
+        namespace = self.entries.pop(entry_id)[0]
+        self.matrix.pop(namespace, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.matrix.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self.entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+expertise_version = 0
+_expertise_listeners: list[typing.Callable[[], None]] = []
+
+
+def on_expertise_change(callback: typing.Callable[[], None]) -> typing.Callable[[], None]:
+    _expertise_listeners.append(callback)
+    return callback
+
+
+def expertise_changed():
+    global expertise_version
+    expertise_version += 1
+    for callback in _expertise_listeners:
+        callback()
+
+
+schema_version = 0
+
+
+def schema_changed():
+    global schema_version
+    schema_version += 1
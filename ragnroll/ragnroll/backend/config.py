@@ -10,7 +10,48 @@ class Settings(pydantic_settings.BaseSettings):
     NEO4J_USE_SSL: bool = False
     NEO4J_SSL_CA_CERT: typing.Optional[str] = ''
     NEO4J_USE_BEARER_TOKEN: bool = False
+    NEO4J_MAX_POOL_SIZE: int = 50
+    NEO4J_MAX_DRIVERS: int = 32
+    NEO4J_DRIVER_IDLE_TIMEOUT: float = 300.0
+    NEO4J_CONNECTION_ACQUISITION_TIMEOUT: float = 30.0
+    NEO4J_MAX_CONNECTION_LIFETIME: typing.Optional[float] = None
     OPENAI_API_KEY: str
+    EMBEDDING_CACHE_SIZE: int = 4096
+    EMBEDDING_CACHE_PATH: typing.Optional[str] = None
+    EMBEDDING_BATCH_SIZE: int = 256
+    EMBEDDING_CONCURRENCY: int = 4
+    LLM_MAX_CONCURRENCY: int = 16
+    LLM_TOKENS_PER_MINUTE: typing.Optional[int] = None
+    LLM_COMPLETION_TOKEN_ESTIMATE: int = 256
+    SEMANTIC_CACHE_ENABLED: bool = False
+    SEMANTIC_CACHE_SIZE: int = 512
+    SEMANTIC_CACHE_THRESHOLD: float = 0.97
+    SEMANTIC_CACHE_TTL: float = 600.0
+    CYPHER_CACHE_SIZE: int = 1024
+    EXPLAIN_CACHE_SIZE: int = 4096
+    SCHEMA_REFRESH_INTERVAL: float = 600.0
+    NEO4J_QUERY_TIMEOUT: float = 30.0
+    SEARCH_TIMEOUT: float = 55.0
+    DISCONNECT_POLL_INTERVAL: float = 0.5
+    SEARCH_BATCH_MAX_QUESTIONS: int = 500
+    SEARCH_BATCH_CONCURRENCY: int = 8
+    RESULT_FETCH_SIZE: int = 100
+    RESULT_MAX_ROWS: int = 1000
+    RESULT_MAX_BYTES: int = 4 * 1024 * 1024
+    ANSWER_CONTEXT_TOKENS: int = 2000
+    ANSWER_CONTEXT_MAX_CELL: int = 200
+    TOKENIZER_ENCODING: str = 'cl100k_base'
+    ANSWER_RULES_ENABLED: bool = True
+    ANSWER_RULE_MAX_ROWS: int = 5
+    ANSWER_RULE_MAX_FIELDS: int = 4
+    VECTOR_INDEX: typing.Literal['neo4j', 'local'] = 'neo4j'
+    VECTOR_INDEX_REFRESH_INTERVAL: float = 300.0
+    ENTITY_INDEXES: list[str] = []
+    ENTITY_MIN_SIMILARITY: float = 0.8
+    ENTITY_CANDIDATES: int = 3
+    ENTITY_MAX_SPAN_WORDS: int = 3
+    LOG_LEVEL: str = 'INFO'
+    LOG_FORMAT: typing.Literal['text', 'json'] = 'text'
     DEBUG: bool = False
     ALLOW_FALLBACK: bool = True
 
@@ -0,0 +1,101 @@
+from . import settings
+from . import serialize
+from . import metrics
+from .scheduler import estimate_tokens
+from .util import cprint
+import asyncio
+import typing
+
+
+class Context(typing.NamedTuple):
+    text: str
+    tokens: int
+    rows: int
+    omitted: int
+
+
+# loaded off the event loop at startup, a cold tiktoken cache downloads the encoding synchronously
+tokenizer: typing.Any = None
+
+
+def load_encoding() -> typing.Any:
+    import tiktoken
+    return tiktoken.get_encoding(settings.TOKENIZER_ENCODING)
+
+
+async def warm():
+    global tokenizer
+    try:
+        tokenizer = await asyncio.to_thread(load_encoding)
+    except Exception as e:
+        # missing package or encoding files that can not be downloaded
+        cprint("> Tokenizer unavailable, estimating token counts", color='red', error=str(e))
+
+
+def count_tokens(text: str) -> int:
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def cell(value: typing.Any, max_chars: int) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        text = 'true' if value else 'false'
+    elif isinstance(value, (str, int, float)):
+        text = str(value)
+    else:
+        text = serialize.dumps(value).decode('utf-8')
+    text = ' '.join(text.split())
+    if len(text) > max_chars:
+        text = text[:max_chars - 1] + '…'
+    return text
+
+
+def columns(data: list[dict]) -> list[str]:
+    return list(dict.fromkeys(k for row in data for k in row))
+
+
+def summarize(rows: list[dict], fields: list[str]) -> list[str]:
+    """Comment lines describing rows left out of the context, numeric columns get their range and total"""
+    lines = [f'# {len(rows)} more rows omitted']
+    for field in fields:
+        values = [row.get(field) for row in rows]
+        values = [v for v in values if v is not None]
+        if values and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            lines.append(f'# {field}: min={min(values)} max={max(values)} sum={sum(values)}')
+    return lines
+
+
+def build_context(data: list[dict], budget: typing.Optional[int] = None,
+                  max_chars: typing.Optional[int] = None) -> Context:
+    """Render rows as TSV under a header line, keeping the leading rows that fit the token budget"""
+    budget = budget or settings.ANSWER_CONTEXT_TOKENS
+    max_chars = max_chars or settings.ANSWER_CONTEXT_MAX_CELL
+    fields = columns(data)
+    lines = ['\t'.join(fields)]
+    costs = [count_tokens(lines[0]) + 1]
+    used = costs[0]
+    for row in data:
+        line = '\t'.join(cell(row.get(f), max_chars) for f in fields)
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        lines.append(line)
+        costs.append(cost)
+        used += cost
+
+    kept = len(lines) - 1
+    summary = []
+    if kept < len(data):
+        # make room for the summary, its size is bounded by the one over every row
+        reserve = count_tokens('\n'.join(summarize(data, fields))) + 1
+        while kept and used + reserve > budget:
+            used -= costs.pop()
+            lines.pop()
+            kept -= 1
+        summary = summarize(data[kept:], fields)
+        metrics.context_rows_omitted.inc(len(data) - kept)
+    text = '\n'.join(lines + summary)
+    return Context(text, count_tokens(text), kept, len(data) - kept)
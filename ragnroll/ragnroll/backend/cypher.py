@@ -0,0 +1,154 @@
+import re
+import typing
+
+TOKEN_PATTERN = re.compile(r'''
+    (?P<space>\s+)
+   |(?P<comment>//[^\n]*|/\*.*?\*/)
+   |(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+   |(?P<identifier>`(?:[^`]|``)*`)
+   |(?P<unterminated>['"`].*|/\*.*)
+   |(?P<parameter>\$(?:\w+|`(?:[^`]|``)*`))
+   |(?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+   |(?P<word>[^\W\d]\w*)
+   |(?P<open>[\(\[\{])
+   |(?P<close>[\)\]\}])
+   |(?P<symbol>.)
+''', re.S | re.X)
+
+IGNORED = ('space', 'comment')
+
+
+class Token(typing.NamedTuple):
+    kind: str
+    text: str
+    start: int
+    end: int
+    depth: int
+
+    def keyword(self, *words: str) -> bool:
+        return self.kind == 'word' and self.text.upper() in words
+
+
+def tokenize(query: str) -> list[Token]:
+    tokens = []
+    depth = 0
+    for m in TOKEN_PATTERN.finditer(query):
+        kind = m.lastgroup
+        if kind == 'close':
+            depth -= 1
+        tokens.append(Token(kind, m.group(), m.start(), m.end(), depth))
+        if kind == 'open':
+            depth += 1
+    return tokens
+
+
+def significant(tokens: list[Token]) -> list[Token]:
+    return [t for t in tokens if t.kind not in IGNORED]
+
+
+def is_clause(tokens: list[Token], i: int, *words: str) -> bool:
+    # top-level keyword that is not a property, alias or map key (n.limit, AS limit, {limit: 1})
+    t = tokens[i]
+    if t.depth != 0 or not t.keyword(*words):
+        return False
+    if i > 0 and (tokens[i - 1].text == '.' or tokens[i - 1].keyword('AS')):
+        return False
+    if i + 1 < len(tokens) and tokens[i + 1].text == ':':
+        return False
+    return True
+
+
+def branches(tokens: list[Token]) -> list[list[Token]]:
+    """Split significant tokens into top-level UNION branches"""
+    result = [[]]
+    i = 0
+    while i < len(tokens):
+        if is_clause(tokens, i, 'UNION'):
+            if i + 1 < len(tokens) and tokens[i + 1].keyword('ALL'):
+                i += 1
+            result.append([])
+        else:
+            result[-1].append(tokens[i])
+        i += 1
+    return result
+
+
+def enforce_limit(query: str, result_limit: int = 20) -> str:
+    """Clamp or append the LIMIT of every top-level RETURN to result_limit"""
+    query = query.strip()
+    tokens = significant(tokenize(query))
+    if tokens and tokens[-1].text == ';' and tokens[-1].depth == 0:
+        query = query[:tokens[-1].start].rstrip()
+        tokens = tokens[:-1]
+    edits: list[tuple[int, int, str]] = []
+    for branch in branches(tokens):
+        returns = [i for i in range(len(branch)) if is_clause(branch, i, 'RETURN')]
+        if not returns:
+            continue
+        limits = [i for i in range(returns[-1] + 1, len(branch)) if is_clause(branch, i, 'LIMIT')]
+        if not limits:
+            edits.append((branch[-1].end, branch[-1].end, f' LIMIT {result_limit}'))
+            continue
+        expression = branch[limits[-1] + 1:]
+        if not expression:
+            edits.append((branch[limits[-1]].end, branch[limits[-1]].end, f' {result_limit}'))
+        elif len(expression) == 1 and expression[0].kind == 'number' and \
+                float(expression[0].text) == int(float(expression[0].text)) and \
+                int(float(expression[0].text)) <= result_limit:
+            # Neo4j only accepts an integer literal, rewrite forms like 5.0 or 010
+            value = str(int(float(expression[0].text)))
+            if expression[0].text != value:
+                edits.append((expression[0].start, expression[-1].end, value))
+        else:
+            edits.append((expression[0].start, expression[-1].end, str(result_limit)))
+    for start, end, text in sorted(edits, reverse=True):
+        query = query[:start] + text + query[end:]
+    return query
+
+
+def parameters(query: str) -> list[str]:
+    """Names of the $parameters referenced by query, in order of first use"""
+    names = []
+    for t in tokenize(query):
+        if t.kind == 'parameter':
+            name = t.text[1:]
+            if name.startswith('`'):
+                name = name[1:-1].replace('``', '`')
+            if name not in names:
+                names.append(name)
+    return names
+
+
+CLAUSES = ('MATCH', 'OPTIONAL', 'WITH', 'UNWIND', 'CALL', 'RETURN', 'USE', 'CYPHER')
+PAIRS = {')': '(', ']': '[', '}': '{'}
+
+
+def validate(query: str) -> typing.Optional[str]:
+    """Cheap syntactic pre-check, returns an error message or None"""
+    tokens = significant(tokenize(query))
+    if not tokens:
+        return 'Query is empty'
+    stack: list[Token] = []
+    for t in tokens:
+        if t.kind == 'unterminated':
+            return f'Unterminated string, identifier or comment at position {t.start}: {t.text[:20]!r}'
+        if t.kind == 'open':
+            stack.append(t)
+        elif t.kind == 'close':
+            if not stack or stack[-1].text != PAIRS[t.text]:
+                return f'Unbalanced {t.text!r} at position {t.start}'
+            stack.pop()
+    if stack:
+        return f'Unclosed {stack[-1].text!r} at position {stack[-1].start}'
+    if not tokens[0].keyword(*CLAUSES):
+        return f'Query must start with a Cypher clause, found {tokens[0].text[:40]!r}. Remove any text that is not Cypher'
+    if tokens[-1].text == ';':
+        tokens = tokens[:-1]
+    for branch in branches(tokens):
+        if not branch:
+            return 'UNION is missing a query on one side'
+        if not any(is_clause(branch, i, 'RETURN') for i in range(len(branch))):
+            # a standalone procedure call is the only query allowed without RETURN
+            if not (branch[0].keyword('CALL') and len(branch) > 1 and branch[1].kind == 'word'):
+                return 'Query is missing a RETURN clause'
+    return None
@@ -1,39 +1,143 @@
 from . import settings
 import fastapi
 import neo4j
+import asyncio
+import hashlib
+import time
+import typing
+import contextlib
 
-def connect(request: fastapi.Request) -> neo4j.AsyncDriver:
-    existing = getattr(request.state, 'neo4j_connection', None)
-    if existing:
-        return existing
 
-    params = dict(
-        uri=settings.NEO4J_URI,
-        database=settings.NEO4J_DATABASE,
-    )
+def bounded(work: typing.Callable) -> typing.Callable:
+    """Transaction function limited to NEO4J_QUERY_TIMEOUT, read when the work is submitted"""
+    return neo4j.unit_of_work(timeout=settings.NEO4J_QUERY_TIMEOUT)(work)
 
-    if settings.NEO4J_USE_SSL:
-        params['encrypted'] = True
-        if settings.NEO4J_SSL_CA_CERT:
-            params['trusted_certificates'] = neo4j.TrustCustomCAs(settings.NEO4J_SSL_CA_CERT)
 
+class DriverEntry(object):
+
+    def __init__(self, driver: neo4j.AsyncDriver) -> None:
+        self.driver = driver
+        self.last_used = time.monotonic()
+        self.in_use = 0
+
+
+class DriverRegistry(object):
+    """Process-wide pool of long-lived drivers, one per auth identity"""
+
+    def __init__(self, max_drivers: int, idle_timeout: float,
+                 driver_factory: typing.Callable[..., neo4j.AsyncDriver] = neo4j.AsyncGraphDatabase.driver) -> None:
+        self.max_drivers = max_drivers
+        self.idle_timeout = idle_timeout
+        self.driver_factory = driver_factory
+        self.entries: dict[str, DriverEntry] = {}
+        self.closing: set[asyncio.Task] = set()
+
+    def driver_params(self) -> dict:
+        params = dict(
+            uri=settings.NEO4J_URI,
+            database=settings.NEO4J_DATABASE,
+            max_connection_pool_size=settings.NEO4J_MAX_POOL_SIZE,
+            connection_acquisition_timeout=settings.NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+        )
+        if settings.NEO4J_MAX_CONNECTION_LIFETIME:
+            params['max_connection_lifetime'] = settings.NEO4J_MAX_CONNECTION_LIFETIME
+
+        if settings.NEO4J_USE_SSL:
+            params['encrypted'] = True
+            if settings.NEO4J_SSL_CA_CERT:
+                params['trusted_certificates'] = neo4j.TrustCustomCAs(settings.NEO4J_SSL_CA_CERT)
+        return params
+
+    def acquire(self, identity: str, auth: typing.Any) -> DriverEntry:
+        entry = self.entries.get(identity, None)
+        if entry is None:
+            self._evict(keep=self.max_drivers - 1)
+            entry = DriverEntry(self.driver_factory(auth=auth, **self.driver_params()))
+            self.entries[identity] = entry
+        entry.last_used = time.monotonic()
+        return entry
+
+    def _close_later(self, entry: DriverEntry):
+        try:
+            task = asyncio.get_running_loop().create_task(entry.driver.close())
+        except RuntimeError:
+            return
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    def _evict(self, keep: int):
+        idle = sorted([(e.last_used, k) for k, e in self.entries.items() if not e.in_use])
+        while len(self.entries) > keep and idle:
+            _, identity = idle.pop(0)
+            self._close_later(self.entries.pop(identity))
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for identity, entry in list(self.entries.items()):
+            if not entry.in_use and entry.last_used < deadline:
+                self._close_later(self.entries.pop(identity))
+
+    async def reap(self, interval: typing.Optional[float] = None):
+        interval = interval or max(self.idle_timeout / 2, 1)
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_idle()
+
+    async def close(self):
+        entries = list(self.entries.values())
+        self.entries.clear()
+        await asyncio.gather(*[e.driver.close() for e in entries], *self.closing)
+
+
+registry = DriverRegistry(max_drivers=settings.NEO4J_MAX_DRIVERS,
+                          idle_timeout=settings.NEO4J_DRIVER_IDLE_TIMEOUT)
+
+
+def resolve_auth(request: typing.Optional[fastapi.Request]) -> tuple[str, typing.Any]:
     auth_header = None
     if request is not None:
         auth_header = request.headers.get('Authorization', default=None)
 
     if request is None:
-        params['auth'] = (settings.NEO4J_USERNAME, settings.NEO4J_PASSWORD)
+        return f'user:{settings.NEO4J_USERNAME}', (settings.NEO4J_USERNAME, settings.NEO4J_PASSWORD)
     elif settings.NEO4J_USE_BEARER_TOKEN and auth_header and auth_header.lower().startswith('bearer'):
-        params['auth'] = neo4j.bearer_auth(auth_header.split(' ')[1])
+        token = auth_header.split(' ')[1]
+        return 'bearer:' + hashlib.sha256(token.encode('utf-8')).hexdigest(), neo4j.bearer_auth(token)
     else:
         if settings.NEO4J_USERNAME and settings.NEO4J_PASSWORD:
-            params['auth'] = (settings.NEO4J_USERNAME, settings.NEO4J_PASSWORD)
+            return f'user:{settings.NEO4J_USERNAME}', (settings.NEO4J_USERNAME, settings.NEO4J_PASSWORD)
         else:
             raise fastapi.HTTPException(status_code=401, detail='Neither database login configured nor authorization header provided')
 
-    driver = neo4j.AsyncGraphDatabase.driver(**params)
-    request.state.neo4j_connection = driver
-    return driver
 
-async def session(request: fastapi.Request) -> neo4j.AsyncSession:
-    return connect(request).session()
\ No newline at end of file
+@contextlib.asynccontextmanager
+async def borrow(request: typing.Optional[fastapi.Request]) -> typing.AsyncIterator[neo4j.AsyncDriver]:
+    identity, auth = resolve_auth(request)
+    entry = registry.acquire(identity, auth)
+    entry.in_use += 1
+    try:
+        yield entry.driver
+    finally:
+        entry.in_use -= 1
+        entry.last_used = time.monotonic()
+
+
+async def driver(request: fastapi.Request) -> typing.AsyncIterator[neo4j.AsyncDriver]:
+    async with borrow(request) as d:
+        yield d
+
+
+async def session(request: fastapi.Request) -> typing.AsyncIterator[neo4j.AsyncSession]:
+    async with borrow(request) as d:
+        async with d.session() as s:
+            yield s
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    reaper = asyncio.create_task(registry.reap())
+    try:
+        yield
+    finally:
+        reaper.cancel()
+        await registry.close()
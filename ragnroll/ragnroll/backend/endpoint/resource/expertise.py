@@ -1,18 +1,21 @@
-from ... import db, model
+from ... import db, model, ingest, scheduler
+from ...cache import expertise_changed
 from ...router import router as app
 
 import fastapi
 import neo4j
 
-from ...langchain import embeddings_model
+from ...langchain import embed_documents
 
 ConfigModel = model.ResultModel[model.ConfigMetadata]
 ConfigModelList = model.Result[list[ConfigModel]]
 ExpertiseModel = model.ResultModel[model.RAGExpertise]
 ExpertiseModelList = model.Result[list[ExpertiseModel]]
 
+UPLOAD_ATTEMPTS = 3
+
 @app.get('/resource/expertise/v1', response_model_exclude_none=True, response_model_exclude_unset=True)
-async def list_expertise(request: fastapi.Request) -> ConfigModelList:
+async def list_expertise(request: fastapi.Request, session: neo4j.AsyncSession = fastapi.Depends(db.session)) -> ConfigModelList:
     async def _job(txn: neo4j.AsyncTransaction):
         query = '''
         MATCH (n:_RAGExpertise)
@@ -20,8 +23,7 @@ async def list_expertise(request: fastapi.Request) -> ConfigModelList:
         '''
         result = await txn.run(query)
         return await result.data()
-    session: neo4j.AsyncSession = await db.session(request)
-    results = await session.execute_read(_job)
+    results = await session.execute_read(db.bounded(_job))
     objs = []
     for r in results:
         if not r.get('title', None):
@@ -32,7 +34,7 @@ async def list_expertise(request: fastapi.Request) -> ConfigModelList:
 
 
 @app.get('/resource/expertise/v1/{identifier}')
-async def get_expertise(request: fastapi.Request, identifier: str) -> ExpertiseModel:
+async def get_expertise(request: fastapi.Request, identifier: str, session: neo4j.AsyncSession = fastapi.Depends(db.session)) -> ExpertiseModel:
     async def _job(txn: neo4j.AsyncTransaction):
         query = '''
         MATCH (n:_RAGExpertise {name: $name})
@@ -40,8 +42,7 @@ async def get_expertise(request: fastapi.Request, identifier: str) -> ExpertiseM
         '''
         result = await txn.run(query, parameters={'name': identifier})
         return await result.single()
-    session: neo4j.AsyncSession = await db.session(request)
-    result: neo4j.Record = await session.execute_read(_job)
+    result: neo4j.Record = await session.execute_read(db.bounded(_job))
     return ExpertiseModel(
         data=model.RAGExpertise.model_validate_json(result['n']['body']), 
         links={
@@ -51,112 +52,40 @@ async def get_expertise(request: fastapi.Request, identifier: str) -> ExpertiseM
 
 
 @app.post('/resource/expertise/v1', response_class=fastapi.responses.RedirectResponse, status_code=303)
-async def upload_expertise(request: fastapi.Request, config: model.RAGExpertise):
-    session: neo4j.AsyncSession = await db.session(request)
-    async def _job(txn: neo4j.AsyncTransaction):
-        query = '''
-        MATCH (n:_RAGExpertise {name: $name})
-        OPTIONAL MATCH (n)-[]-(p:_RAGPattern)
-        OPTIONAL MATCH (p)-[]-(o:_RAGOutput)
-        OPTIONAL MATCH (o)-[]-(q:_RAGQuery)
-        OPTIONAL MATCH (p)-[]-(k:_RAGQuestion)
-        DETACH DELETE o
-        DETACH DELETE k
-        DETACH DELETE q
-        DETACH DELETE n
-        DETACH DELETE p
-        '''
-        result = await txn.run(query, parameters={
-            'name': config.metadata.name
-        })
-        query = '''
-        MERGE (n:_RAGExpertise {name: $name})
-        SET n.filesize = $filesize,
-            n.body = $body
-        '''
-        jsondata = config.model_dump_json(indent=4)
-        result = await txn.run(query=query, parameters={
-            'name': config.metadata.name,
-            'body': jsondata,
-            'filesize': len(jsondata),
-            'filetype': 'application/json'
-        })
+async def upload_expertise(request: fastapi.Request, config: model.RAGExpertise, session: neo4j.AsyncSession = fastapi.Depends(db.session)):
+    scheduler.priority.set(scheduler.Priority.BULK)
+    scheduler.tenant.set(db.resolve_auth(request)[0])
+    async def _read(txn: neo4j.AsyncTransaction):
+        return await ingest.read_expertise(txn, config.metadata.name)
+    flat = ingest.flatten_expertise(config)
+    for _ in range(UPLOAD_ATTEMPTS):
+        existing = await session.execute_read(db.bounded(_read))
+        diff = ingest.diff_expertise(existing, flat)
+        texts = ingest.pending_embeddings(existing, diff)
+        embeddings = dict(zip(texts, await embed_documents(texts)))
 
-        for pattern in config.spec.patterns:
-            query = '''
-                MERGE (n:_RAGExpertise {name: $expertise_name})
-                MERGE (p:_RAGPattern {expertise: $expertise_name, name: $pattern_name})
-                MERGE (n)-[:HAS_PATTERN]-(p)
-            '''
-            await txn.run(query=query, parameters={
-                'expertise_name': config.metadata.name,
-                'pattern_name': pattern.name,
-            })
-            for question in pattern.questions:
-                query = '''
-                    MATCH (p:_RAGPattern {expertise: $expertise_name, name: $pattern_name})
-                    MERGE (p)-[:HAS_QUESTION]->(k:_RAGQuestion {expertise: $expertise_name, pattern: $pattern_name, name: $question_name, question: $question, language: $language})
-                    SET k.embedding = $embedding
-                '''
-                embedding = await embeddings_model.aembed_query(question.question)
-                await txn.run(query=query, parameters={
-                    'expertise_name': config.metadata.name,
-                    'pattern_name': pattern.name,
-                    'question_name': question.name,
-                    'question': question.question,
-                    'language': question.language,
-                    'embedding': embedding
-                })
-            for output in pattern.outputs:
-                for sample in output.samples:
-                    query = '''
-                        MATCH (p:_RAGPattern {expertise: $expertise_name, name: $pattern_name})
-                        MERGE (o:_RAGOutput {expertise: $expertise_name, pattern: $pattern_name, name: $output_name})
-                        MERGE (o)-[:HAS_QUERY]->(q:_RAGQuery {expertise: $expertise_name, pattern: $pattern_name, output: $output_name, query: $query})
-                        MERGE (p)-[:HAS_OUTPUT]->(o)
-                        SET o.visualization = $visualization
-                        SET o.order = $order
-                    '''
-                    await txn.run(query=query, parameters={
-                        'expertise_name': config.metadata.name,
-                        'pattern_name': pattern.name,
-                        'output_name': output.name,
-                        'query': sample.query,
-                        'visualization': output.visualization,
-                        'order': output.order
-                    })
-                    for question in sample.questions:
-                        query = '''
-                            MATCH (question:_RAGQuestion {expertise: $expertise_name, pattern: $pattern_name, name: $question_name})
-                            MATCH (query:_RAGQuery {expertise: $expertise_name, pattern: $pattern_name, output: $output_name, query: $query})
-                            MERGE (query)-[:ANSWERS]->(question)
-                        '''
-                        await txn.run(query=query, parameters={
-                            'expertise_name': config.metadata.name,
-                            'pattern_name': pattern.name,
-                            'question_name': question.name,
-                            'output_name': output.name,
-                            'query': sample.query
-                        })
-    result = await session.execute_write(_job)
+        async def _job(txn: neo4j.AsyncTransaction):
+            # the diff was computed outside this transaction
+            await ingest.check_unchanged(txn, config.metadata.name, existing)
+            await ingest.write_expertise(txn, config, diff, embeddings)
+        try:
+            await session.execute_write(_job)
+            break
+        except ingest.StaleExpertise:
+            continue
+    else:
+        raise fastapi.HTTPException(status_code=409, detail=(
+            f'Expertise {config.metadata.name} is being changed by another upload, retry later'))
+    expertise_changed()
     return fastapi.responses.RedirectResponse(url=f'/resource/expertise/v1/{config.metadata.name}', status_code=303)
 
 
 @app.delete('/resource/expertise/v1/{identifier}', response_model_exclude_unset=True)
-async def delete_expertise(request: fastapi.Request, identifier: str) -> model.Result[model.Message]:
+async def delete_expertise(request: fastapi.Request, identifier: str, session: neo4j.AsyncSession = fastapi.Depends(db.session)) -> model.Result[model.Message]:
     async def _job(txn: neo4j.AsyncTransaction):
-        query = '''
-        MATCH (n:_RAGExpertise {name: $name})
-        OPTIONAL MATCH (n)-[]-(p:_RAGPattern)
-        OPTIONAL MATCH (p)-[]-(q:_RAGQuery)
-        OPTIONAL MATCH (q)-[]-(k:_RAGQuestion)
-        DETACH DELETE k
-        DETACH DELETE q
-        DETACH DELETE n
-        '''
-        await txn.run(query=query, parameters={'name': identifier})
-    session: neo4j.AsyncSession = await db.session(request)
+        await txn.run(ingest.DELETE_EXPERTISE, parameters={'expertise_name': identifier})
     await session.execute_write(_job)
+    expertise_changed()
     return model.Result[model.Message](
         data=model.Message(message=f'Deleted {identifier}')
     )
\ No newline at end of file
@@ -1,30 +1,248 @@
 from .. import db, model, settings
 from ..router import router as app
-from ..langchain import embeddings_model
-from ..rag import answer_question, default_search
-from ..util import format_text
+from ..langchain import embed_query, embed_documents
+from ..rag import stream_answers, default_search, answer_cache, answer_cache_key, find_queries_many, SearchOutput
+from ..util import cprint
+from .. import scheduler
+from .. import metrics
+from .. import entity
 
 import fastapi
+import fastapi.responses
+import asyncio
+import contextlib
+import neo4j
+import time
+import typing
 
 
-async def _search(request: fastapi.Request, question: str) -> model.SearchResult:
-    print(format_text(f"> Searching: '{question}'", bold=True))
-    print(format_text("> Entering embedding calculation", bold=True))
-    embedding = await embeddings_model.aembed_query(question)
-    print(format_text("> Embedding done", bold=True))
-    driver = db.connect(request)
-    answers = await answer_question(question, embedding=embedding, driver=driver)
+async def _answers(request: fastapi.Request, question: str, driver: neo4j.AsyncDriver,
+                   on_token: typing.Optional[typing.Callable[[int, str], None]] = None,
+                   embedding: typing.Optional[list[float]] = None,
+                   outputs: typing.Optional[list[SearchOutput]] = None,
+                   ) -> typing.AsyncIterator[tuple[int, model.SearchResultItem]]:
+    cprint("> Searching", question=question)
+    if embedding is None:
+        with metrics.timer('embedding'):
+            embedding = await embed_query(question)
+    identity = db.resolve_auth(request)[0]
+    scheduler.tenant.set(identity)
+    entities = None
+    cache_key = None
+    if settings.SEMANTIC_CACHE_ENABLED:
+        # resolved up front so the cache only answers questions about the same values
+        async with driver.session() as session:
+            entities = await entity.resolve_entities(session, question)
+        cache_key = answer_cache_key(question, entities)
+        cached = answer_cache.get(identity, embedding, key=cache_key)
+        if cached is not None:
+            cprint("> Answered from semantic cache", question=question)
+            for i, item in enumerate(cached):
+                yield i, item
+            return
+    answers = []
+    next_index = 0
+    async for index, item in stream_answers(question, embedding=embedding, driver=driver, on_token=on_token,
+                                            outputs=outputs, entities=entities):
+        next_index = max(next_index, index + 1)
+        if item:
+            answers.append(item)
+            yield index, item
     if not answers and settings.ALLOW_FALLBACK:
-        answers = await default_search(question, driver=driver)
-    return model.SearchResult(data=answers)
+        fallback_token = (lambda delta: on_token(next_index, delta)) if on_token else None
+        with metrics.timer('fallback'):
+            fallback = await default_search(question, driver=driver, on_token=fallback_token)
+        for i, item in enumerate(fallback):
+            answers.append(item)
+            yield next_index + i, item
+    if answers and settings.SEMANTIC_CACHE_ENABLED:
+        answer_cache.set(identity, embedding, sorted(answers, key=lambda r: r.order), key=cache_key)
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+@contextlib.asynccontextmanager
+async def _guard(request: fastapi.Request, stage: str = 'search', deadline: bool = True):
+    """Cancel the enclosed work when the client disconnects or SEARCH_TIMEOUT passes, recording the stage once"""
+    timeout = settings.SEARCH_TIMEOUT if deadline else None
+    task = asyncio.current_task()
+    disconnected = False
+    start = time.perf_counter()
+
+    async def watch():
+        nonlocal disconnected
+        while not await request.is_disconnected():
+            await asyncio.sleep(settings.DISCONNECT_POLL_INTERVAL)
+        disconnected = True
+        task.cancel()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        async with asyncio.timeout(timeout):
+            yield
+    except asyncio.CancelledError:
+        metrics.stage_cancelled.inc(stage=stage)
+        if not disconnected:
+            raise
+        task.uncancel()
+        cprint("> Client disconnected, search cancelled", color='red')
+        raise ClientDisconnected()
+    except TimeoutError:
+        metrics.stage_timeouts.inc(stage=stage)
+        cprint("> Search deadline exceeded", color='red', timeout=timeout)
+        raise
+    except Exception:
+        metrics.stage_errors.inc(stage=stage)
+        raise
+    finally:
+        watcher.cancel()
+        metrics.stage_duration.observe(time.perf_counter() - start, stage=stage)
+
+
+async def _search(request: fastapi.Request, question: str, driver: neo4j.AsyncDriver) -> model.SearchResult:
+    answers = []
+    try:
+        async with _guard(request):
+            async for _, item in _answers(request, question, driver):
+                answers.append(item)
+    except TimeoutError:
+        # return whatever completed before the deadline
+        pass
+    except ClientDisconnected:
+        return model.SearchResult(data=[])
+    return model.SearchResult(data=sorted(answers, key=lambda r: r.order))
+
+
+async def _stream(request: fastapi.Request, question: str) -> typing.AsyncIterator[str]:
+    queue: asyncio.Queue[typing.Optional[model.SearchEvent]] = asyncio.Queue()
+
+    def on_token(index: int, delta: str):
+        queue.put_nowait(model.SearchEvent(event=model.SearchEventType.TOKEN, index=index, delta=delta))
+
+    async def produce():
+        try:
+            async with db.borrow(request) as driver:
+                answers = {}
+                # the timer sees a disconnect as cancellation, the deadline is caught inside it
+                with metrics.timer('search'):
+                    try:
+                        async with asyncio.timeout(settings.SEARCH_TIMEOUT):
+                            async for index, item in _answers(request, question, driver, on_token=on_token):
+                                answers[index] = item
+                                queue.put_nowait(model.SearchEvent(event=model.SearchEventType.RESULT,
+                                                                   index=index, item=item))
+                    except TimeoutError:
+                        metrics.stage_timeouts.inc(stage='search')
+                        cprint("> Search deadline exceeded", color='red', timeout=settings.SEARCH_TIMEOUT)
+                order = sorted(answers.keys(), key=lambda i: answers[i].order)
+                queue.put_nowait(model.SearchEvent(event=model.SearchEventType.DONE, order=order))
+        finally:
+            queue.put_nowait(None)
+
+    task = asyncio.create_task(produce())
+    try:
+        while (event := await queue.get()) is not None:
+            yield event.model_dump_json(exclude_none=True) + '\n'
+        await task
+    finally:
+        # the response stops iterating when the client disconnects
+        if not task.done():
+            task.cancel()
+
+
+async def _batch(request: fastapi.Request, questions: list[str],
+                 driver: neo4j.AsyncDriver) -> typing.AsyncIterator[model.SearchBatchItem]:
+    """Answer every question, yielding one item per input position as its question completes"""
+    positions: dict[str, list[int]] = {}
+    for i, question in enumerate(questions):
+        positions.setdefault(question, []).append(i)
+    unique = list(positions.keys())
+    if not unique:
+        return
+    scheduler.tenant.set(db.resolve_auth(request)[0])
+    scheduler.priority.set(scheduler.Priority.BULK)
+    cprint("> Batch search", questions=len(questions), unique=len(unique))
+
+    with metrics.timer('embedding'):
+        embeddings = await embed_documents(unique)
+    async with driver.session() as session:
+        outputs = await find_queries_many(session, embeddings)
+
+    semaphore = asyncio.Semaphore(settings.SEARCH_BATCH_CONCURRENCY)
+
+    async def _answer(i: int) -> tuple[str, list[model.SearchResultItem]]:
+        async with semaphore:
+            items = [item async for _, item in _answers(request, unique[i], driver,
+                                                         embedding=embeddings[i], outputs=outputs[i])]
+        return unique[i], sorted(items, key=lambda r: r.order)
+
+    tasks = [asyncio.ensure_future(_answer(i)) for i in range(len(unique))]
+    try:
+        for task in asyncio.as_completed(tasks):
+            question, items = await task
+            for index in positions[question]:
+                yield model.SearchBatchItem(index=index, question=question, data=items)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _batch_questions(payload: list[model.SearchParam]) -> list[str]:
+    if len(payload) > settings.SEARCH_BATCH_MAX_QUESTIONS:
+        raise fastapi.HTTPException(status_code=422, detail=(
+            f'Batch of {len(payload)} questions exceeds the limit of {settings.SEARCH_BATCH_MAX_QUESTIONS}'))
+    return [p.question for p in payload]
+
+
+async def _batch_stream(request: fastapi.Request, questions: list[str]) -> typing.AsyncIterator[str]:
+    async with db.borrow(request) as driver:
+        async for item in _batch(request, questions, driver):
+            yield item.model_dump_json(exclude_none=True) + '\n'
 
 
 # Search
 @app.get("/search", response_model_exclude_none=True, response_model_exclude_unset=True)
-async def search(request: fastapi.Request, question: str) -> model.SearchResult:
-    return await _search(request, question)
+async def search(request: fastapi.Request, question: str,
+                 driver: neo4j.AsyncDriver = fastapi.Depends(db.driver)) -> model.SearchResult:
+    return await _search(request, question, driver)
 
 
 @app.post("/search", response_model_exclude_none=True, response_model_exclude_unset=True)
-async def post_search(request: fastapi.Request, payload: model.SearchParam) -> model.SearchResult:
-    return await _search(request, payload.question)
\ No newline at end of file
+async def post_search(request: fastapi.Request, payload: model.SearchParam,
+                      driver: neo4j.AsyncDriver = fastapi.Depends(db.driver)) -> model.SearchResult:
+    return await _search(request, payload.question, driver)
+
+
+# Streaming search, newline delimited SearchEvents: text answer tokens, completed results, final order
+@app.get("/search/stream", response_class=fastapi.responses.StreamingResponse)
+async def search_stream(request: fastapi.Request, question: str):
+    # fail with 401 before the response starts
+    db.resolve_auth(request)
+    return fastapi.responses.StreamingResponse(_stream(request, question), media_type='application/x-ndjson')
+
+
+@app.post("/search/stream", response_class=fastapi.responses.StreamingResponse)
+async def post_search_stream(request: fastapi.Request, payload: model.SearchParam):
+    # fail with 401 before the response starts
+    db.resolve_auth(request)
+    return fastapi.responses.StreamingResponse(_stream(request, payload.question), media_type='application/x-ndjson')
+
+
+# Batch search, one item per submitted question in submission order, or newline delimited as each completes
+@app.post("/search/batch", response_model_exclude_none=True, response_model_exclude_unset=True)
+async def search_batch(request: fastapi.Request, payload: list[model.SearchParam], stream: bool = False,
+                       driver: neo4j.AsyncDriver = fastapi.Depends(db.driver)):
+    questions = _batch_questions(payload)
+    if stream:
+        return fastapi.responses.StreamingResponse(_batch_stream(request, questions),
+                                                   media_type='application/x-ndjson')
+    items = []
+    try:
+        async with _guard(request, stage='batch', deadline=False):
+            async for item in _batch(request, questions, driver):
+                items.append(item)
+    except ClientDisconnected:
+        items = []
+    return model.Result[model.SearchBatchItem](data=sorted(items, key=lambda i: i.index))
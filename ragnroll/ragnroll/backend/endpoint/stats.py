@@ -0,0 +1,60 @@
+from .. import db, model, metrics
+from ..router import router as app, reflex_app
+from ..langchain import embedding_cache
+from ..rag import answer_cache, cypher_cache, explain_cache, parameter_cache
+from ..schema import schema_provider
+from ..scheduler import llm_scheduler
+from ..vector import question_index
+
+import fastapi
+import fastapi.responses
+import neo4j
+
+
+def _caches() -> dict[str, dict]:
+    return {'embedding': embedding_cache.stats(), 'answer': answer_cache.stats(),
+            'cypher': cypher_cache.stats(), 'parameter': parameter_cache.stats(),
+            'explain': explain_cache.stats(),
+            'schema': schema_provider.stats(), 'vector': question_index.stats()}
+
+
+def _cache_stat(field: str):
+    return lambda: {(name, ): s.get(field, 0) for name, s in _caches().items()}
+
+
+metrics.CallbackGauge('ragnroll_cache_hits', 'Cache hits since startup', ('cache',), _cache_stat('hits'))
+metrics.CallbackGauge('ragnroll_cache_misses', 'Cache misses since startup', ('cache',), _cache_stat('misses'))
+metrics.CallbackGauge('ragnroll_cache_entries', 'Entries held by each cache', ('cache',), _cache_stat('size'))
+metrics.CallbackGauge('ragnroll_schema_introspection_last_seconds', 'Duration of the last schema introspection', (),
+                      lambda: {(): schema_provider.last_duration})
+metrics.CallbackGauge('ragnroll_llm_active', 'LLM calls holding a scheduler slot', (),
+                      lambda: {(): llm_scheduler.active})
+metrics.CallbackGauge('ragnroll_llm_queued', 'LLM calls waiting for a scheduler slot', (),
+                      lambda: {(): llm_scheduler.queued()})
+
+
+@app.get('/stats', response_model_exclude_none=True, response_model_exclude_unset=True)
+async def stats(request: fastapi.Request) -> model.Result[model.CacheStats]:
+    return model.Result[model.CacheStats](data=[
+        model.CacheStats(name=name, **s) for name, s in _caches().items()
+    ])
+
+
+@app.get('/stats/scheduler', response_model_exclude_none=True, response_model_exclude_unset=True)
+async def scheduler_stats(request: fastapi.Request) -> model.Result[model.SchedulerStats]:
+    return model.Result[model.SchedulerStats](data=model.SchedulerStats(**llm_scheduler.stats()))
+
+
+@app.post('/stats/schema/refresh', response_model_exclude_unset=True)
+async def refresh_schema(request: fastapi.Request,
+                         driver: neo4j.AsyncDriver = fastapi.Depends(db.driver)) -> model.Result[model.Message]:
+    await schema_provider.refresh(driver)
+    return model.Result[model.Message](
+        data=model.Message(message=f'Schema refreshed in {schema_provider.last_duration:.3f}s')
+    )
+
+
+# Prometheus text exposition, mounted on the app directly to bypass the YAML/JSON response handling
+@reflex_app.api.get('/metrics', include_in_schema=False)
+async def prometheus_metrics() -> fastapi.responses.PlainTextResponse:
+    return fastapi.responses.PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
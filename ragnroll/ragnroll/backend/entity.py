@@ -0,0 +1,189 @@
+from . import settings
+from . import model
+from . import metrics
+from . import db
+from .util import cprint
+import difflib
+import re
+import typing
+import neo4j
+import neo4j.exceptions
+
+ENTITY_INDEX = 'ragnroll_entity'
+
+LUCENE_SPECIAL = re.compile(r'([+\-!(){}\[\]^"~*?:\\/]|&&|\|\|)')
+WORD = re.compile(r'\w+')
+STOPWORDS = frozenset('''
+    a an and are as at be by did do does for from has have how i in is it many me much of on or show
+    tell than that the their there these this to was were what when where which who whom whose why with
+'''.split())
+
+RESOLVE_QUERY = '''
+    UNWIND $spans AS span
+    CALL {
+        WITH span
+        CALL db.index.fulltext.queryNodes($index, span.query, {limit: $limit})
+        YIELD node, score
+        RETURN node, score
+    }
+    RETURN span.start AS start, span.end AS end, elementId(node) AS id, labels(node) AS labels,
+           [p IN $properties WHERE node[p] IS NOT NULL | [p, toString(node[p])]] AS values, score
+'''
+
+SHOW_INDEX_QUERY = '''
+    SHOW FULLTEXT INDEXES YIELD name, labelsOrTypes, properties
+    WHERE name = $index
+    RETURN labelsOrTypes AS labels, properties
+'''
+
+
+class Entity(typing.NamedTuple):
+    span: str
+    start: int
+    end: int
+    label: str
+    property: str
+    value: str
+    element_id: str
+    score: float
+
+
+def index_targets() -> dict[str, list[str]]:
+    """Configured Label:property pairs grouped by label"""
+    targets: dict[str, list[str]] = {}
+    for item in settings.ENTITY_INDEXES:
+        label, _, prop = item.partition(':')
+        if not label or not prop:
+            raise ValueError(f'Invalid ENTITY_INDEXES entry {item!r}, expected Label:property')
+        targets.setdefault(label, [])
+        if prop not in targets[label]:
+            targets[label].append(prop)
+    return targets
+
+
+def index_properties(targets: dict[str, list[str]]) -> list[str]:
+    return list(dict.fromkeys(p for props in targets.values() for p in props))
+
+
+def quote(name: str) -> str:
+    return '`' + name.replace('`', '``') + '`'
+
+
+async def create_index(txn: neo4j.AsyncTransaction):
+    targets = index_targets()
+    existing = await (await txn.run(SHOW_INDEX_QUERY, parameters={'index': ENTITY_INDEX})).single()
+    properties = index_properties(targets)
+    if existing is not None:
+        if set(existing['labels']) == set(targets) and set(existing['properties']) == set(properties):
+            return
+        await txn.run(f'DROP INDEX {quote(ENTITY_INDEX)} IF EXISTS')
+    if not targets:
+        return
+    await txn.run(f'''
+        CREATE FULLTEXT INDEX {quote(ENTITY_INDEX)} IF NOT EXISTS
+            FOR (n:{'|'.join(quote(label) for label in targets)})
+            ON EACH [{', '.join('n.' + quote(p) for p in properties)}]
+    ''')
+
+
+def lucene_query(words: list[str]) -> str:
+    # lowercase terms so AND/OR/NOT in the question are never read as operators, the analyzer
+    # lowercases indexed values anyway; fuzzy match longer words, exact match short ones
+    terms = [LUCENE_SPECIAL.sub(r'\\\1', w.lower()) + ('~' if len(w) > 3 else '') for w in words]
+    return ' AND '.join(terms)
+
+
+def question_spans(question: str, max_words: int = 3) -> list[dict]:
+    words = list(WORD.finditer(question))
+    spans = []
+    for i in range(len(words)):
+        for j in range(i, min(i + max_words, len(words))):
+            chunk = words[i:j + 1]
+            texts = [w.group() for w in chunk]
+            if texts[0].lower() in STOPWORDS or texts[-1].lower() in STOPWORDS:
+                continue
+            if len(texts) == 1 and len(texts[0]) < 3:
+                continue
+            spans.append({'start': chunk[0].start(), 'end': chunk[-1].end(), 'query': lucene_query(texts)})
+    return spans
+
+
+def similarity(a: str, b: str) -> float:
+    return difflib.SequenceMatcher(None, a.casefold(), b.casefold()).ratio()
+
+
+def select_entities(question: str, rows: list[dict], targets: dict[str, list[str]],
+                    min_similarity: float) -> list[Entity]:
+    candidates = []
+    for row in rows:
+        span = question[row['start']:row['end']]
+        labels = [label for label in row['labels'] if label in targets]
+        best = None
+        for prop, value in row['values']:
+            for label in labels:
+                if prop not in targets[label]:
+                    continue
+                score = similarity(span, value)
+                if score >= min_similarity and (best is None or score > best.score):
+                    best = Entity(span, row['start'], row['end'], label, prop, value, row['id'], score)
+        if best is not None:
+            candidates.append(best)
+    # prefer the closest and then the longest match, spans and nodes are used once
+    candidates.sort(key=lambda e: (-e.score, -(e.end - e.start)))
+    chosen: list[Entity] = []
+    for entity in candidates:
+        if any(entity.start < c.end and c.start < entity.end or entity.element_id == c.element_id
+               for c in chosen):
+            continue
+        chosen.append(entity)
+    return sorted(chosen, key=lambda e: e.start)
+
+
+async def resolve_entities(session: neo4j.AsyncSession, question: str) -> list[Entity]:
+    """Map spans of the question to indexed nodes in a single full-text lookup"""
+    targets = index_targets()
+    if not targets:
+        return []
+    spans = question_spans(question, max_words=settings.ENTITY_MAX_SPAN_WORDS)
+    if not spans:
+        return []
+
+    async def _job(txn: neo4j.AsyncTransaction):
+        result = await txn.run(RESOLVE_QUERY, parameters={
+            'spans': spans, 'index': ENTITY_INDEX, 'limit': settings.ENTITY_CANDIDATES,
+            'properties': index_properties(targets)})
+        return await result.data()
+
+    try:
+        with metrics.timer('entity_resolution'):
+            rows = await session.execute_read(db.bounded(_job))
+    except neo4j.exceptions.ClientError as e:
+        # entity resolution only improves a search, it must never fail one
+        cprint("> Unable to resolve entities", color='red', question=question, error=str(e))
+        return []
+    entities = select_entities(question, rows, targets, settings.ENTITY_MIN_SIMILARITY)
+    if entities:
+        cprint("> Resolved entities", entities=[f'{e.label}.{e.property}={e.value!r}' for e in entities])
+    return entities
+
+
+def describe(entities: list[Entity]) -> str:
+    if not entities:
+        return '(none)'
+    return '\n'.join(f'- "{e.span}" is {e.label} with {e.property} = {e.value!r}' for e in entities)
+
+
+def match_parameters(parameters: list[model.RAGQueryParameter], entities: list[Entity]) -> dict[str, str]:
+    """Values for parameter slots bound to an entity label (or Label.property), in question order"""
+    values = {}
+    used = set()
+    for p in parameters:
+        if not p.entity:
+            continue
+        label, _, prop = p.entity.partition('.')
+        for e in entities:
+            if e.element_id not in used and e.label == label and (not prop or e.property == prop):
+                values[p.name] = e.value
+                used.add(e.element_id)
+                break
+    return values
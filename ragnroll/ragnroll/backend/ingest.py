@@ -0,0 +1,287 @@
+from . import model
+from . import cypher
+import hashlib
+import json
+import neo4j
+import typing
+
+
+class FlatExpertise(typing.TypedDict):
+    patterns: list[dict]
+    questions: list[dict]
+    outputs: list[dict]
+    queries: list[dict]
+
+
+class ExpertiseDiff(typing.TypedDict):
+    upsert: FlatExpertise
+    delete: FlatExpertise
+
+
+class StaleExpertise(Exception):
+    """Stored expertise changed after the diff against it was computed"""
+
+
+KEYS = {
+    'patterns': ('name',),
+    'questions': ('pattern', 'name'),
+    'outputs': ('pattern', 'name'),
+    'queries': ('pattern', 'output', 'query'),
+}
+
+
+def content_hash(*parts: typing.Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def row_key(kind: str, row: dict) -> tuple:
+    return tuple(row[k] for k in KEYS[kind])
+
+
+def sample_parameters(sample: model.RAGQuery) -> list[model.RAGQueryParameter]:
+    """Declared parameter slots, or string slots for every $parameter in the query"""
+    if sample.parameters is not None:
+        return sample.parameters
+    return [model.RAGQueryParameter(name=name) for name in cypher.parameters(sample.query)
+            if name not in model.RESERVED_PARAMETERS]
+
+
+def flatten_expertise(config: model.RAGExpertise) -> FlatExpertise:
+    patterns = {}
+    questions = {}
+    outputs = {}
+    queries = {}
+    for pattern in config.spec.patterns:
+        patterns[pattern.name] = {'name': pattern.name}
+        for question in pattern.questions:
+            questions[(pattern.name, question.name)] = {
+                'pattern': pattern.name,
+                'name': question.name,
+                'question': question.question,
+                'language': str(question.language),
+                'hash': content_hash(question.question, str(question.language)),
+            }
+        for output in pattern.outputs:
+            outputs[(pattern.name, output.name)] = {
+                'pattern': pattern.name,
+                'name': output.name,
+                'visualization': str(output.visualization),
+                'order': output.order,
+                'answer_template': output.answer_template,
+                'answer_language': str(output.answer_language),
+                'hash': content_hash(str(output.visualization), output.order, output.answer_template,
+                                     str(output.answer_language)),
+            }
+            for sample in output.samples:
+                row = queries.setdefault((pattern.name, output.name, sample.query), {
+                    'pattern': pattern.name,
+                    'output': output.name,
+                    'query': sample.query,
+                    'parameters': json.dumps([p.model_dump(mode='json', exclude_none=True)
+                                              for p in sample_parameters(sample)]),
+                    'questions': [],
+                })
+                for question in sample.questions:
+                    if question.name not in row['questions']:
+                        row['questions'].append(question.name)
+    for row in queries.values():
+        row['hash'] = content_hash(row['query'], row['parameters'], sorted(row['questions']))
+    return FlatExpertise(
+        patterns=list(patterns.values()),
+        questions=list(questions.values()),
+        outputs=list(outputs.values()),
+        queries=list(queries.values()),
+    )
+
+
+def empty_expertise() -> FlatExpertise:
+    return FlatExpertise(patterns=[], questions=[], outputs=[], queries=[])
+
+
+def diff_expertise(existing: FlatExpertise, current: FlatExpertise) -> ExpertiseDiff:
+    diff = ExpertiseDiff(upsert=empty_expertise(), delete=empty_expertise())
+    for kind in KEYS.keys():
+        stored = {row_key(kind, r): r for r in existing[kind]}
+        current_keys = set()
+        for row in current[kind]:
+            key = row_key(kind, row)
+            current_keys.add(key)
+            old = stored.get(key, None)
+            if old is None or old.get('hash', None) != row.get('hash', None):
+                diff['upsert'][kind].append(row)
+        diff['delete'][kind] = [r for k, r in stored.items() if k not in current_keys]
+
+    # queries referencing newly created questions need their ANSWERS edges rebuilt
+    new_questions = {row_key('questions', r) for r in diff['upsert']['questions']} - \
+                    {row_key('questions', r) for r in existing['questions']}
+    upserted = {row_key('queries', r) for r in diff['upsert']['queries']}
+    for row in current['queries']:
+        if row_key('queries', row) in upserted:
+            continue
+        if any((row['pattern'], name) in new_questions for name in row['questions']):
+            diff['upsert']['queries'].append(row)
+    return diff
+
+
+def fingerprint(flat: FlatExpertise) -> dict[str, dict[tuple, typing.Optional[str]]]:
+    """Row keys and hashes of each kind, independent of row order"""
+    return {kind: {row_key(kind, r): r.get('hash', None) for r in flat[kind]} for kind in KEYS.keys()}
+
+
+def pending_embeddings(existing: FlatExpertise, diff: ExpertiseDiff) -> list[str]:
+    stored = {row_key('questions', r): r.get('question', None) for r in existing['questions']}
+    texts = [r['question'] for r in diff['upsert']['questions']
+             if stored.get(row_key('questions', r), None) != r['question']]
+    return list(dict.fromkeys(texts))
+
+
+READ_EXPERTISE = '''
+    CALL {
+        MATCH (p:_RAGPattern {expertise: $expertise_name})
+        RETURN collect({name: p.name}) AS patterns
+    }
+    CALL {
+        MATCH (k:_RAGQuestion {expertise: $expertise_name})
+        RETURN collect({pattern: k.pattern, name: k.name, question: k.question, hash: k.hash}) AS questions
+    }
+    CALL {
+        MATCH (o:_RAGOutput {expertise: $expertise_name})
+        RETURN collect({pattern: o.pattern, name: o.name, hash: o.hash}) AS outputs
+    }
+    CALL {
+        MATCH (q:_RAGQuery {expertise: $expertise_name})
+        RETURN collect({pattern: q.pattern, output: q.output, query: q.query, hash: q.hash}) AS queries
+    }
+    RETURN patterns, questions, outputs, queries
+'''
+
+DELETE_EXPERTISE = '''
+    CALL {
+        MATCH (q:_RAGQuery {expertise: $expertise_name})
+        DETACH DELETE q
+    }
+    CALL {
+        MATCH (o:_RAGOutput {expertise: $expertise_name})
+        DETACH DELETE o
+    }
+    CALL {
+        MATCH (k:_RAGQuestion {expertise: $expertise_name})
+        DETACH DELETE k
+    }
+    CALL {
+        MATCH (p:_RAGPattern {expertise: $expertise_name})
+        DETACH DELETE p
+    }
+    CALL {
+        MATCH (n:_RAGExpertise {name: $expertise_name})
+        DETACH DELETE n
+    }
+'''
+
+DELETE_ITEMS = '''
+    CALL {
+        UNWIND $queries AS row
+        MATCH (q:_RAGQuery {expertise: $expertise_name, pattern: row.pattern, output: row.output, query: row.query})
+        DETACH DELETE q
+    }
+    CALL {
+        UNWIND $outputs AS row
+        MATCH (o:_RAGOutput {expertise: $expertise_name, pattern: row.pattern, name: row.name})
+        DETACH DELETE o
+    }
+    CALL {
+        UNWIND $questions AS row
+        MATCH (k:_RAGQuestion {expertise: $expertise_name, pattern: row.pattern, name: row.name})
+        DETACH DELETE k
+    }
+    CALL {
+        UNWIND $patterns AS row
+        MATCH (p:_RAGPattern {expertise: $expertise_name, name: row.name})
+        DETACH DELETE p
+    }
+'''
+
+WRITE_PATTERNS = '''
+    MERGE (n:_RAGExpertise {name: $expertise_name})
+    SET n.filesize = $filesize,
+        n.body = $body
+    WITH n
+    UNWIND $patterns AS row
+    MERGE (p:_RAGPattern {expertise: $expertise_name, name: row.name})
+    MERGE (n)-[:HAS_PATTERN]-(p)
+'''
+
+WRITE_QUESTIONS = '''
+    UNWIND $questions AS row
+    MATCH (p:_RAGPattern {expertise: $expertise_name, name: row.pattern})
+    MERGE (p)-[:HAS_QUESTION]->(k:_RAGQuestion {expertise: $expertise_name, pattern: row.pattern, name: row.name})
+    SET k.question = row.question,
+        k.language = row.language,
+        k.hash = row.hash,
+        k.embedding = coalesce(row.embedding, k.embedding)
+'''
+
+WRITE_OUTPUTS = '''
+    UNWIND $outputs AS row
+    MATCH (p:_RAGPattern {expertise: $expertise_name, name: row.pattern})
+    MERGE (o:_RAGOutput {expertise: $expertise_name, pattern: row.pattern, name: row.name})
+    MERGE (p)-[:HAS_OUTPUT]->(o)
+    SET o.visualization = row.visualization,
+        o.order = row.order,
+        o.answer_template = row.answer_template,
+        o.answer_language = row.answer_language,
+        o.hash = row.hash
+'''
+
+WRITE_QUERIES = '''
+    UNWIND $queries AS row
+    MATCH (o:_RAGOutput {expertise: $expertise_name, pattern: row.pattern, name: row.output})
+    MERGE (o)-[:HAS_QUERY]->(q:_RAGQuery {expertise: $expertise_name, pattern: row.pattern, output: row.output, query: row.query})
+    SET q.hash = row.hash,
+        q.parameters = row.parameters
+    WITH q, row
+    OPTIONAL MATCH (q)-[a:ANSWERS]->()
+    DELETE a
+    WITH DISTINCT q, row
+    UNWIND row.questions AS question_name
+    MATCH (k:_RAGQuestion {expertise: $expertise_name, pattern: row.pattern, name: question_name})
+    MERGE (q)-[:ANSWERS]->(k)
+'''
+
+
+async def read_expertise(txn: neo4j.AsyncTransaction, name: str) -> FlatExpertise:
+    result = await txn.run(READ_EXPERTISE, parameters={'expertise_name': name})
+    record = await result.single()
+    if record is None:
+        return empty_expertise()
+    return FlatExpertise(**record.data())
+
+
+async def check_unchanged(txn: neo4j.AsyncTransaction, name: str, existing: FlatExpertise):
+    """Raise StaleExpertise when a concurrent upload changed what the diff was computed against"""
+    if fingerprint(await read_expertise(txn, name)) != fingerprint(existing):
+        raise StaleExpertise(name)
+
+
+async def write_expertise(txn: neo4j.AsyncTransaction, config: model.RAGExpertise,
+                          diff: ExpertiseDiff, embeddings: dict[str, list[float]]):
+    name = config.metadata.name
+    jsondata = config.model_dump_json(indent=4)
+    upsert = diff['upsert']
+    questions = [dict(r, embedding=embeddings.get(r['question'], None)) for r in upsert['questions']]
+
+    if any(diff['delete'].values()):
+        await txn.run(DELETE_ITEMS, parameters={'expertise_name': name, **diff['delete']})
+    await txn.run(WRITE_PATTERNS, parameters={
+        'expertise_name': name,
+        'body': jsondata,
+        'filesize': len(jsondata),
+        # every pattern, an expertise node recreated after a delete must link the unchanged ones too
+        'patterns': [{'name': p.name} for p in config.spec.patterns],
+    })
+    if questions:
+        await txn.run(WRITE_QUESTIONS, parameters={'expertise_name': name, 'questions': questions})
+    if upsert['outputs']:
+        await txn.run(WRITE_OUTPUTS, parameters={'expertise_name': name, 'outputs': upsert['outputs']})
+    if upsert['queries']:
+        await txn.run(WRITE_QUERIES, parameters={'expertise_name': name, 'queries': upsert['queries']})
@@ -1,4 +1,50 @@
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from . import settings
+from .cache import EmbeddingCache
+from .scheduler import llm_scheduler, estimate_tokens
+import asyncio
 
 chat_model = ChatOpenAI()
-embeddings_model = OpenAIEmbeddings()
\ No newline at end of file
+embeddings_model = OpenAIEmbeddings()
+
+embedding_cache = EmbeddingCache(model_name=embeddings_model.model,
+                                 maxsize=settings.EMBEDDING_CACHE_SIZE,
+                                 path=settings.EMBEDDING_CACHE_PATH)
+
+
+async def _embed_batches(texts: list[str]) -> list[list[float]]:
+    semaphore = asyncio.Semaphore(settings.EMBEDDING_CONCURRENCY)
+    size = settings.EMBEDDING_BATCH_SIZE
+
+    async def _batch(batch: list[str]) -> list[list[float]]:
+        async with semaphore:
+            async with llm_scheduler.call('embedding', sum(estimate_tokens(t) for t in batch)):
+                return await embeddings_model.aembed_documents(batch)
+
+    batches = await asyncio.gather(*[_batch(texts[i:i + size]) for i in range(0, len(texts), size)])
+    return [v for batch in batches for v in batch]
+
+
+async def embed_documents(texts: list[str]) -> list[list[float]]:
+    vectors = await embedding_cache.get_many(texts)
+    pending = {}
+    for text in texts:
+        if text not in vectors:
+            pending.setdefault(embedding_cache.key(text), text)
+    if pending:
+        missing = list(pending.values())
+        computed = await embedding_cache.set_many(dict(zip(missing, await _embed_batches(missing))))
+        for text in texts:
+            if text not in vectors:
+                vectors[text] = computed[pending[embedding_cache.key(text)]]
+    return [vectors[t].tolist() for t in texts]
+
+
+async def embed_query(text: str) -> list[float]:
+    vectors = await embedding_cache.get_many([text])
+    if text in vectors:
+        return vectors[text].tolist()
+    async with llm_scheduler.call('embedding', estimate_tokens(text)):
+        vector = await embeddings_model.aembed_query(text)
+    await embedding_cache.set_many({text: vector})
+    return vector
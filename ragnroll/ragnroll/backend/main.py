@@ -5,7 +5,9 @@ import uvicorn
 import functools
 import asyncio
 import neo4j
-from .db import connect
+from .db import borrow, registry
+from . import entity
+from .util import setup_logging
 
 serve = functools.partial(uvicorn.run, 'ragnroll.app:app')
 
@@ -23,10 +25,11 @@ async def _initdb(txn: neo4j.AsyncTransaction):
     await txn.run(query)
 
 async def initdb():
-    driver = connect(None)
-    session: neo4j.AsyncSession = driver.session()
-    async with session:
-        await session.execute_write(_initdb)
+    async with borrow(None) as driver:
+        async with driver.session() as session:
+            await session.execute_write(_initdb)
+            await session.execute_write(entity.create_index)
+    await registry.close()
     print('InitDB Completed')
 
 async def get_parser():
@@ -47,9 +50,10 @@ def run(args=sys.argv[1:]):
 async def arun(args=sys.argv[1:]):
     commands = {
         'serve': serve,
-        'initdb': initdb
+        'initdb': initdb,
     }
 
+    setup_logging()
     parser = await get_parser()
     p_args = parser.parse_args(args=args)
     if getattr(p_args, 'command', None) is None: 
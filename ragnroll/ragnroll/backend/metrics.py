@@ -0,0 +1,153 @@
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+import typing
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_labels(labelnames: tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for k, v in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels: dict[str, typing.Any]) -> LabelValues:
+        return tuple(str(labels.get(k, '')) for k in self.labelnames)
+
+    def samples(self) -> typing.Iterable[str]:
+        return []
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> typing.Iterable[str]:
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values: dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> typing.Iterable[str]:
+        with self.lock:
+            items = [(k, list(v[0]), v[1]) for k, v in self.values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="%s"' % ('+Inf' if bound == float('inf') else repr(bound))
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}'
+
+
+class CallbackGauge(Metric):
+    """Gauge whose values are read from a callback at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...],
+                 callback: typing.Callable[[], dict[LabelValues, float]]) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self) -> typing.Iterable[str]:
+        for key, value in self.callback().items():
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+REGISTRY: list[Metric] = []
+
+
+def render() -> str:
+    return '\n'.join(m.render() for m in REGISTRY) + '\n'
+
+
+stage_duration = Histogram('ragnroll_stage_duration_seconds', 'Time spent in each search pipeline stage', ('stage',))
+stage_errors = Counter('ragnroll_stage_errors_total', 'Errors raised by each search pipeline stage', ('stage',))
+stage_cancelled = Counter('ragnroll_stage_cancelled_total', 'Work cancelled by a disconnect or deadline, per stage', ('stage',))
+stage_timeouts = Counter('ragnroll_stage_timeouts_total', 'Work that ran past its timeout, per stage', ('stage',))
+parameter_fallbacks = Counter('ragnroll_parameter_fallbacks_total', 'Templated queries whose parameters could not be filled, by fallback', ('to',))
+correction_retries = Counter('ragnroll_correction_retries_total', 'Cypher correction rounds sent to the LLM')
+llm_calls = Counter('ragnroll_llm_calls_total', 'LLM and embedding API calls', ('kind',))
+llm_errors = Counter('ragnroll_llm_errors_total', 'Failed LLM and embedding API calls', ('kind',))
+results_truncated = Counter('ragnroll_results_truncated_total', 'Query results cut at the row cap or byte budget')
+result_rows = Histogram('ragnroll_result_rows', 'Rows read per generated query',
+                        buckets=(0, 1, 5, 10, 20, 50, 100, 250, 500, 1000, 5000))
+llm_queue_wait = Histogram('ragnroll_llm_queue_wait_seconds', 'Time LLM calls waited for a scheduler slot', ('priority',))
+prompt_tokens = Histogram('ragnroll_prompt_tokens', 'Tokens in answer prompts, and in the result context within them',
+                          ('part',), buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000))
+context_rows_omitted = Counter('ragnroll_context_rows_omitted_total', 'Result rows left out of answer contexts by the token budget')
+answer_paths = Counter('ragnroll_answer_paths_total', 'Text answers by how they were produced', ('path',))
+
+
+@contextlib.contextmanager
+def timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        stage_cancelled.inc(stage=stage)
+        raise
+    except TimeoutError:
+        stage_timeouts.inc(stage=stage)
+        raise
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_duration.observe(time.perf_counter() - start, stage=stage)
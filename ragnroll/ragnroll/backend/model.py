@@ -1,10 +1,15 @@
 import pydantic
 import enum
+import string
 import typing
 import neo4j
+from . import cypher
 
 NAME_PATTERN=r'^[a-z0-9\-]*$'
 
+# bound by the pipeline itself, never filled from the question
+RESERVED_PARAMETERS = ('result_limit',)
+
 T = typing.TypeVar('T', bound=pydantic.BaseModel)
 M = typing.TypeVar('M', bound=pydantic.BaseModel)
 
@@ -34,6 +39,12 @@ class VisualizationType(enum.StrEnum):
     PIE_CHART = 'pie-chart'
 
 
+class AnswerPath(enum.StrEnum):
+    TEMPLATE = 'template'
+    RULE = 'rule'
+    LLM = 'llm'
+
+
 class Language(enum.StrEnum):
     en_US = 'en_US'
     ms_MY = 'ms_MY'
@@ -46,15 +57,58 @@ class RAGQuestion(pydantic.BaseModel):
 class NameReference(pydantic.BaseModel):
     name: str = pydantic.Field(strict=True, pattern=NAME_PATTERN)
 
+class ParameterType(enum.StrEnum):
+    STRING = 'string'
+    INTEGER = 'integer'
+    FLOAT = 'float'
+    BOOLEAN = 'boolean'
+    LIST = 'list'
+
+class RAGQueryParameter(pydantic.BaseModel):
+    name: str = pydantic.Field(strict=True, pattern=r'^[A-Za-z_][A-Za-z0-9_]*$')
+    type: ParameterType = ParameterType.STRING
+    description: typing.Optional[str] = None
+    default: typing.Optional[typing.Any] = None
+    # Label or Label.property of an indexed entity that can fill this slot without the LLM
+    entity: typing.Optional[str] = None
+
 class RAGQuery(pydantic.BaseModel):
     questions: list[NameReference]  = pydantic.Field(default_factory=lambda : [NameReference(name='default')])
     query: str 
+    # parameter slots filled from the question, inferred from $parameters in the query when omitted
+    parameters: typing.Optional[list[RAGQueryParameter]] = None
+
+    @pydantic.model_validator(mode='after')
+    def check_parameters(self) -> 'RAGQuery':
+        if self.parameters is not None:
+            used = cypher.parameters(self.query)
+            declared = [p.name for p in self.parameters]
+            for name in declared:
+                if name not in used:
+                    raise ValueError(f'Parameter {name!r} is not used in query')
+            for name in used:
+                if name not in declared and name not in RESERVED_PARAMETERS:
+                    raise ValueError(f'Query parameter {name!r} is not declared in parameters')
+        return self
 
 class RAGOutput(pydantic.BaseModel):
     name: str = pydantic.Field(strict=True, pattern=NAME_PATTERN)
     visualization: VisualizationType = VisualizationType.TEXT_ANSWER
     samples: list[RAGQuery]
     order: int = 0
+    # str.format template over result row fields, e.g. "There are {total} open tickets"
+    answer_template: typing.Optional[str] = None
+    # language of the template and of rule answers, questions in other languages are answered by the LLM
+    answer_language: Language = Language.en_US
+
+    @pydantic.field_validator('answer_template')
+    @classmethod
+    def check_answer_template(cls, value: typing.Optional[str]) -> typing.Optional[str]:
+        if value is not None:
+            for _, field, _, _ in string.Formatter().parse(value):
+                if field == '' or (field and not field.isidentifier()):
+                    raise ValueError('Answer template fields must be named result columns')
+        return value
 
 class RAGPattern(pydantic.BaseModel):
     name: str = pydantic.Field(strict=True, pattern=NAME_PATTERN)
@@ -81,9 +135,20 @@ class Axes(pydantic.BaseModel):
     y: typing.Optional[str] = None
     z: typing.Optional[str] = None
 
+WIRE_JSON = ('Compact JSON: no whitespace after separators, non-ASCII text as UTF-8 rather than \\u escapes. '
+             'Decode it with a JSON parser, do not compare it as text.')
+
 class SearchQueryMeta(pydantic.BaseModel):
     query: str
-    result: str
+    result: str = pydantic.Field(description='Query result rows. ' + WIRE_JSON)
+    parameters: typing.Optional[str] = pydantic.Field(
+        default=None, description='Values bound to the query parameters. ' + WIRE_JSON)
+    rows: typing.Optional[int] = None
+    bytes: typing.Optional[int] = None
+    truncated: typing.Optional[bool] = None
+    # answer prompt size, and how many result rows fit in its context
+    prompt_tokens: typing.Optional[int] = None
+    context_rows: typing.Optional[int] = None
 
 class SearchResultItem(pydantic.BaseModel):
     data: list[dict]
@@ -92,6 +157,35 @@ class SearchResultItem(pydantic.BaseModel):
     fields: list[str]
     axes: Axes = pydantic.Field(default_factory=Axes)
     order: int = 0
+    # the result of at least one query was cut at the row cap or byte budget
+    truncated: bool = False
+    # how a text answer was produced
+    answer_path: typing.Optional[AnswerPath] = None
+
+class SearchBatchItem(pydantic.BaseModel):
+    index: int
+    question: str
+    data: list[SearchResultItem]
+
+class SchedulerStats(pydantic.BaseModel):
+    active: int
+    queued: int
+    max_concurrency: int
+    waits: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+
+class SearchEventType(enum.StrEnum):
+    TOKEN = 'token'
+    RESULT = 'result'
+    DONE = 'done'
+
+class SearchEvent(pydantic.BaseModel):
+    event: SearchEventType
+    index: typing.Optional[int] = None
+    item: typing.Optional[SearchResultItem] = None
+    delta: typing.Optional[str] = None
+    order: typing.Optional[list[int]] = None
 
 class Error(pydantic.BaseModel):
     detail: typing.Optional[str] = None
@@ -124,3 +218,12 @@ class ExtendedResult(Result, typing.Generic[T, M]):
 
 class SearchResult(Result[list[SearchResultItem]]):
     pass
+
+class CacheStats(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(extra='allow')
+
+    name: str
+    size: int
+    maxsize: int
+    hits: int
+    misses: int
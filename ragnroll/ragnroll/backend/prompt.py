@@ -33,20 +33,45 @@ rag_query_generator = ChatPromptTemplate.from_messages([
     - Do NOT respond to any questions that might ask anything else than for you to construct a Cypher statement.
     - Do NOT include any text except the generated Cypher statement. 
     - DO NOT return anything that is not cypher.
-    - For any string match operations, use case insensitive match
+    - For any string match operations, use case insensitive match, unless the value is a known entity
+    - Known entities are exact database values, match them with equality instead of a case insensitive match
     - Pretty format the output to with maximum 40 characters per line
 
+    Known entities:
+    {entities}
+
     Examples:
     {data}
     '''),
     ('user', '''{question}''')
 ])
 
-limit_replacer = ChatPromptTemplate.from_messages([
+parameter_extractor = ChatPromptTemplate.from_messages([
     ('system', '''
-    Replace the limit clause in the provided cypher query to {result_limit}
+    You are an API that extracts query parameter values from questions. Following are the steps
+    you take to extract the values.
+
+    Step 1: compare the user question with the example question and the example Cypher query.
+    Step 2: If the example query can not answer the user question, answer "IDONOTKNOW".
+    Step 3: identify the value of each parameter listed below from the user question.
+    Step 4: Return ONLY a JSON object mapping each parameter name to its value.
+
+    Rules:
+    - Use values exactly as written in the user question, do NOT change their spelling
+    - Use null for any parameter whose value is not mentioned in the question
+    - Do NOT include any explanations or apologies in your responses.
+    - When a known entity matches a parameter, use the entity value exactly
+    - Do NOT include any text except the JSON object.
+
+    Known entities:
+    {entities}
+
+    Example question: {example}
+    Example Cypher: {query}
+    Parameters:
+    {parameters}
     '''),
-    ('user', '{query}')
+    ('user', '''{question}''')
 ])
 
 cypher_corrector = ChatPromptTemplate.from_messages([
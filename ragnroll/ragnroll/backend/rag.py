@@ -4,61 +4,71 @@ import yaml.parser
 from . import model
 from . import db
 from . import settings
-from .langchain import chat_model, embeddings_model
+from .langchain import chat_model, embed_query
 import neo4j
 import neo4j.exceptions
 import typing
 import urllib.parse
 from . import prompt
+from . import cypher
+from . import scheduler
+from . import metrics
+from . import entity
+from . import serialize
+from .context import build_context, count_tokens
+from .answer import render_answer
+from .entity import Entity
+from .schema import schema_provider
+from .vector import question_index
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_core.messages.base import BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain.chains import GraphCypherQAChain
 from langchain_community.chains.graph_qa.prompts import CYPHER_GENERATION_PROMPT, CYPHER_QA_PROMPT
-from langchain_community.chains.graph_qa.cypher import construct_schema
 from langchain_core.runnables.base import RunnableSerializable
 from langchain_community.chains.graph_qa.cypher import extract_cypher
 from .util import cprint
-from langchain_community.graphs import Neo4jGraph
+from . import cache
+from .cache import SemanticCache, LRUCache, MISSING, normalize_question, on_expertise_change
 import json
 import asyncio
-import neo4j.spatial
-import neo4j.time
-import neo4j.graph
 import magic
 import yaml
 import yaml.parser
 import openai
 import os
 import re
+import hashlib
+import functools
+
+answer_cache: SemanticCache[list[model.SearchResultItem]] = SemanticCache(
+    maxsize=settings.SEMANTIC_CACHE_SIZE,
+    threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+    ttl=settings.SEMANTIC_CACHE_TTL)
+on_expertise_change(answer_cache.clear)
+
+NUMBER = re.compile(r'\d+(?:[.,]\d+)*')
+
+def answer_cache_key(question: str, entities: list[Entity]) -> tuple:
+    """Values a query would be bound to, questions that embed alike but name other values must not share answers"""
+    return (tuple(NUMBER.findall(question)),
+            tuple(sorted((e.label, e.property, e.value) for e in entities)))
+
+cypher_cache: LRUCache[tuple[str, str, int, str], typing.Optional[str]] = LRUCache(maxsize=settings.CYPHER_CACHE_SIZE)
+on_expertise_change(cypher_cache.clear)
+
+explain_cache: LRUCache[tuple[str, int], bool] = LRUCache(maxsize=settings.EXPLAIN_CACHE_SIZE)
+
+parameter_cache: LRUCache[tuple[str, str, str], typing.Optional[dict]] = LRUCache(maxsize=settings.CYPHER_CACHE_SIZE)
+on_expertise_change(parameter_cache.clear)
 
 class CypherChainOutput(typing.TypedDict):
     query: str 
     result: str
     intermediate_steps: list[dict]
 
-class Neo4jJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-#        if isinstance(obj, neo4j.graph.Node):
-#            return {'labels': obj.labels, 'properties': dict(obj)}
-#        elif isinstance(obj, neo4j.graph.Relationship):
-#            return {'type': obj.type, 'properties': dict(obj)}
-#        elif isinstance(obj, neo4j.graph.Path):
-#            return {'nodes': list(obj.nodes), 'relationships': list(obj.relationships)}
-#        elif isinstance(obj, neo4j.spatial.Point):
-#            return {'crs': obj.crs, 'coordinates': obj.coordinates}
-#        elif isinstance(obj, neo4j.time.Duration):
-#            return {'months': obj.months, 'days': obj.days, 'seconds': obj.seconds, 'nanoseconds': obj.nanoseconds}
-        if isinstance(obj, neo4j.time.Date):
-            return obj.iso_format()
-        elif isinstance(obj, neo4j.time.Time):
-            return obj.iso_format()
-        elif isinstance(obj, neo4j.time.DateTime):
-            return obj.iso_format()
-        return super().default(obj)
-
-def jsonify_result(data: typing.Any, **kwargs):
-    return json.dumps(data, cls=Neo4jJSONEncoder, **kwargs)
+def jsonify_result(data: typing.Any, pretty: bool = False) -> str:
+    return serialize.dumps(data, pretty=pretty).decode('utf-8')
 
 class QueryCorrector(object):
 
@@ -67,20 +77,33 @@ class QueryCorrector(object):
         self.session = session
         self.retries = retries
 
+    async def explain(self, query: str) -> typing.Optional[str]:
+        key = (hashlib.sha256(query.encode('utf-8')).hexdigest(), cache.schema_version)
+        if explain_cache.get(key, False):
+            return None
+        try:
+            async def run(txn: neo4j.AsyncTransaction):
+                return await (await txn.run(f'EXPLAIN {query}')).data()
+            with metrics.timer('explain'):
+                res = await self.session.execute_read(db.bounded(run))
+        except (neo4j.exceptions.CypherSyntaxError) as e:
+            return e.message
+        explain_cache.set(key, True)
+        return None
+
     async def __call__(self, query: str):
         retry = 0
         while retry < self.retries:
-            try:
-                async def run(txn: neo4j.AsyncTransaction):
-                    return await (await txn.run(f'EXPLAIN {query}')).data()
-                res = await self.session.execute_read(run)
+            error = cypher.validate(query)
+            if error is None:
+                error = await self.explain(query)
+            if error is None:
                 return query
-            except (neo4j.exceptions.CypherSyntaxError) as e:
-                cprint("> Correcting query: ", bold=True)
-                cprint(query, color='yellow')
-                cprint(e.message, color='red')
-                message: BaseMessage = await self.chain.ainvoke({'query': query, 'error': e.message})
-                query = extract_cypher(message.content)
+            cprint("> Correcting query", color='red', query=query, error=error, retry=retry)
+            metrics.correction_retries.inc()
+            with metrics.timer('correction'):
+                message: BaseMessage = await scheduler.ainvoke(self.chain, {'query': query, 'error': error})
+            query = extract_cypher(message.content)
             retry += 1
         return None
 
@@ -89,33 +112,17 @@ class OutputQuery(pydantic.BaseModel):
     question: str 
     query: str
     score: float
+    parameters: list[model.RAGQueryParameter] = pydantic.Field(default_factory=list)
+    language: model.Language = model.Language.en_US
 
 class SearchOutput(pydantic.BaseModel):
     visualization: model.VisualizationType
     queries: list[OutputQuery]
     order: int = 0
+    answer_template: typing.Optional[str] = None
+    answer_language: model.Language = model.Language.en_US
 
-async def find_queries(session: neo4j.AsyncSession,
-                        embedding: list[float]) -> list[SearchOutput]:
-    async def _job(txn: neo4j.AsyncTransaction):
-        count = 5
-        min_score = 0.9
-        cypher = '''
-            CALL db.index.vector.queryNodes('ragquestion_embedding', $count, $embedding)
-            YIELD node, score
-            WITH node, score
-               WHERE '_RAGQuestion' in labels(node)
-               AND score > $min_score
-            MATCH (query:_RAGQuery)-[:ANSWERS]-(node)
-            MATCH (query)-[HAS_OUTPUT]-(output:_RAGOutput)
-            RETURN distinct query, node as question, output, score
-           ''' 
-        res = await txn.run(cypher, parameters={'embedding': embedding, 'count': count, 
-                                                'min_score': min_score})
-        queries = await res.data()
-        return queries
-    
-    matches = await session.execute_read(_job)
+def group_outputs(matches: list[dict]) -> list[SearchOutput]:
     outputs = {}
     for m in matches:
         output_name = m['output']['name']
@@ -123,80 +130,317 @@ async def find_queries(session: neo4j.AsyncSession,
             name=output_name,
             queries=[],
             visualization=m['output']['visualization'],
-            order=m['output']['order']
+            order=m['output']['order'],
+            answer_template=m['output'].get('answer_template', None),
+            # outputs stored before answer_language existed were written for en_US
+            answer_language=m['output'].get('answer_language', None) or model.Language.en_US,
         )
         outputs.setdefault(output_name, default_item)
         outputs[output_name]['queries'].append(
             OutputQuery(
                 question=m['question']['question'],
                 query=m['query']['query'],
-                score=m['score']
+                score=m['score'],
+                parameters=json.loads(m['query'].get('parameters', None) or '[]'),
+                language=m['question'].get('language', None) or model.Language.en_US,
             )
         )
 
     return sorted([SearchOutput(**o) for o in outputs.values()], key=lambda o: o.order)
 
-async def enforce_limit(query: str, result_limit: int = 20):
-    limit_chain = prompt.limit_replacer | chat_model
-    query = query.strip()
-    if query.endswith(';'):
-        query = query[:-1]
-    if 'limit ' not in query.lower():
-        query = query + f' LIMIT {result_limit};'
-    limits = re.findall(r'limit *(\d+)', query.lower())
-    if limits:
-        limit = 0
-        try:
-            limit = int(limits[-1])
-        except ValueError: 
-            pass
-        if limit > result_limit:
-            cprint(f"> Limit exceeds {result_limit}. Replacing limit", bold=True)
-            message: BaseMessage = await limit_chain.ainvoke({'result_limit': result_limit, 'query': query})
-            query = message.content
-    return query
+async def find_queries_many(session: neo4j.AsyncSession,
+                            embeddings: list[list[float]]) -> list[list[SearchOutput]]:
+    """Outputs matching each embedding, looked up in a single round trip"""
+    count = 5
+    min_score = 0.9
+
+    async def _job(txn: neo4j.AsyncTransaction):
+        cypher = '''
+            UNWIND range(0, size($embeddings) - 1) AS i
+            CALL db.index.vector.queryNodes('ragquestion_embedding', $count, $embeddings[i])
+            YIELD node, score
+            WITH i, node, score
+               WHERE '_RAGQuestion' in labels(node)
+               AND score > $min_score
+            MATCH (query:_RAGQuery)-[:ANSWERS]-(node)
+            MATCH (query)-[HAS_OUTPUT]-(output:_RAGOutput)
+            RETURN distinct i, query, node as question, output, score
+           ''' 
+        res = await txn.run(cypher, parameters={'embeddings': embeddings, 'count': count, 
+                                                'min_score': min_score})
+        queries = await res.data()
+        return queries
+
+    if not embeddings:
+        return []
+    with metrics.timer('find_queries'):
+        if settings.VECTOR_INDEX == 'local':
+            matches = await question_index.query(session, embeddings, count, min_score)
+        else:
+            matches = await session.execute_read(db.bounded(_job))
+    grouped: list[list[dict]] = [[] for _ in embeddings]
+    for m in matches:
+        grouped[m['i']].append(m)
+    return [group_outputs(g) for g in grouped]
+
+async def find_queries(session: neo4j.AsyncSession,
+                        embedding: list[float]) -> list[SearchOutput]:
+    return (await find_queries_many(session, [embedding]))[0]
+
+def sample_set_hash(samples: list[OutputQuery]) -> str:
+    pairs = sorted((sample.question, sample.query) for sample in samples)
+    return hashlib.sha256(json.dumps(pairs).encode('utf-8')).hexdigest()
 
 async def generate_query_from_sample(session: neo4j.AsyncSession, question: str, 
-                                      samples: list[OutputQuery], result_limit: int = 20):
-    cprint("> Entering intent based query generator", bold=True)
-    cprint("> Sample queries:", bold=True)
-    for s in samples:
-        cprint('> ' + s.query, color='yellow')
+                                      samples: list[OutputQuery], result_limit: int = 20,
+                                      entities: typing.Optional[list[Entity]] = None):
+    known_entities = entity.describe(entities or [])
+    cache_key = (normalize_question(question), sample_set_hash(samples), result_limit, known_entities)
+    query = cypher_cache.get(cache_key, MISSING)
+    if query is not MISSING:
+        cprint("> Cached generated query", query=query)
+        return query
+
+    cprint("> Entering intent based query generator", samples=[s.query for s in samples])
     chain = prompt.rag_query_generator | chat_model
-    message: BaseMessage = await chain.ainvoke({'data': '\n\n'.join([
-            f"Question: {sample.question}\nQuery: {sample.query}" for sample in samples
-        ]), 'question': question, 'result_limit': result_limit})
+    with metrics.timer('generation'):
+        message: BaseMessage = await scheduler.ainvoke(chain, {'data': '\n\n'.join([
+                f"Question: {sample.question}\nQuery: {sample.query}" for sample in samples
+            ]), 'question': question, 'result_limit': result_limit, 'entities': known_entities})
     query = message.content
     if query != 'IDONOTKNOW':
-        query = await enforce_limit(query, result_limit=result_limit)
+        with metrics.timer('limit_enforcement'):
+            query = cypher.enforce_limit(query, result_limit=result_limit)
         query_corrector = QueryCorrector(session)
         query = await query_corrector(query)
     else:
+        cypher_cache.set(cache_key, None)
         return None
-    cprint(f"> Generated query:", bold=True)
-    cprint(query, color='yellow')
+    cypher_cache.set(cache_key, query)
+    cprint("> Generated query", query=query)
     return query
 
-async def fetch_output(output: SearchOutput, question: str, driver: neo4j.AsyncDriver, result_limit: int = 20):
+def template_sample(samples: list[OutputQuery]) -> typing.Optional[OutputQuery]:
+    """Closest sample when it declares parameter slots, so only the values need generating"""
+    best = max(samples, key=lambda s: s.score, default=None)
+    if best is not None and best.parameters:
+        return best
+    return None
+
+def coerce_parameter(parameter: model.RAGQueryParameter, value: typing.Any) -> typing.Any:
+    if value is None:
+        return parameter.default
+    if parameter.type == model.ParameterType.INTEGER:
+        return int(value)
+    if parameter.type == model.ParameterType.FLOAT:
+        return float(value)
+    if parameter.type == model.ParameterType.BOOLEAN:
+        return value if isinstance(value, bool) else str(value).strip().lower() in ('true', 'yes', '1')
+    if parameter.type == model.ParameterType.LIST:
+        return value if isinstance(value, list) else [value]
+    return str(value)
+
+def parse_parameters(content: str) -> typing.Optional[dict]:
+    content = re.sub(r'^```(?:json)?|```$', '', content.strip()).strip()
+    if content == 'IDONOTKNOW':
+        return None
+    try:
+        values = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    return values if isinstance(values, dict) else None
+
+async def fill_parameters(question: str, sample: OutputQuery,
+                          entities: typing.Optional[list[Entity]] = None) -> typing.Optional[dict]:
+    resolved = entity.match_parameters(sample.parameters, entities or [])
+    coerced = {}
+    for p in sample.parameters:
+        if p.name in resolved:
+            try:
+                coerced[p.name] = coerce_parameter(p, resolved[p.name])
+            except (TypeError, ValueError):
+                # an entity that does not convert to the declared type is left for the model to fill
+                pass
+    if len(coerced) == len(sample.parameters):
+        cprint("> Filled query parameters from entities", query=sample.query, parameters=coerced)
+        return coerced
+    known_entities = entity.describe(entities or [])
+    cache_key = (normalize_question(question), sample.query, known_entities)
+    parameters = parameter_cache.get(cache_key, MISSING)
+    if parameters is not MISSING:
+        return parameters
+
+    chain = prompt.parameter_extractor | chat_model
+    with metrics.timer('parameter_fill'):
+        message: BaseMessage = await scheduler.ainvoke(chain, {
+            'example': sample.question, 'query': sample.query, 'question': question, 'entities': known_entities,
+            'parameters': '\n'.join(f'- {p.name} ({p.type})' + (f': {p.description}' if p.description else '')
+                                    for p in sample.parameters)})
+    values = parse_parameters(message.content)
+    parameters = None
+    if values is not None:
+        # resolved entities are exact database values, they win over the model's spelling
+        values.update(coerced)
+        try:
+            parameters = {p.name: coerce_parameter(p, values.get(p.name, None)) for p in sample.parameters}
+        except (TypeError, ValueError):
+            parameters = None
+    if parameters is not None and any(v is None for v in parameters.values()):
+        parameters = None
+    parameter_cache.set(cache_key, parameters)
+    cprint("> Filled query parameters", query=sample.query, parameters=parameters)
+    return parameters
+
+def default_parameters(sample: OutputQuery) -> typing.Optional[dict]:
+    """The sample's declared defaults, None unless every parameter has a usable one"""
+    try:
+        parameters = {p.name: coerce_parameter(p, p.default) for p in sample.parameters}
+    except (TypeError, ValueError):
+        return None
+    if any(v is None for v in parameters.values()):
+        return None
+    return parameters
+
+class QueryResult(typing.NamedTuple):
+    data: list[dict]
+    rows: int
+    bytes: int
+    truncated: bool
+    # compact JSON of data, encoded once while the rows were read
+    encoded: bytes = b'[]'
+
+    @property
+    def text(self) -> str:
+        return self.encoded.decode('utf-8')
+
+async def read_result(txn: neo4j.AsyncTransaction, query: str, parameters: typing.Optional[dict] = None,
+                      max_rows: typing.Optional[int] = None, max_bytes: typing.Optional[int] = None) -> QueryResult:
+    """Stream records until the row cap or byte budget is reached, discarding the rest"""
+    max_rows = max_rows or settings.RESULT_MAX_ROWS
+    max_bytes = max_bytes or settings.RESULT_MAX_BYTES
+    result = await txn.run(query, parameters=parameters or {})
+    data = []
+    encoded = []
+    size = 0
+    truncated = False
+    async for record in result:
+        row = record.data()
+        chunk = serialize.dumps(row)
+        if len(data) >= max_rows or size + len(chunk) > max_bytes:
+            truncated = True
+            break
+        data.append(row)
+        encoded.append(chunk)
+        size += len(chunk)
+    await result.consume()
+    if truncated:
+        metrics.results_truncated.inc()
+    metrics.result_rows.observe(len(data))
+    return QueryResult(data, len(data), size, truncated, serialize.dumps_rows(encoded))
+
+async def execute_query(driver: neo4j.AsyncDriver, query: str,
+                        parameters: typing.Optional[dict] = None) -> QueryResult:
+    async with driver.session(fetch_size=settings.RESULT_FETCH_SIZE) as session:
+        try:
+            with metrics.timer('execution'):
+                result = await session.execute_read(db.bounded(read_result), query, parameters)
+        except neo4j.exceptions.ClientError as e:
+            if 'TransactionTimedOut' not in (e.code or ''):
+                raise
+            metrics.stage_timeouts.inc(stage='execution')
+            cprint("> Query timed out", color='red', query=query, timeout=settings.NEO4J_QUERY_TIMEOUT)
+            return QueryResult([], 0, 0, True)
+    if result.truncated:
+        cprint("> Result truncated", color='red', query=query, rows=result.rows, bytes=result.bytes)
+    return result
+
+TokenCallback = typing.Callable[[str], None]
+
+class Answer(typing.NamedTuple):
+    text: str
+    prompt_tokens: typing.Optional[int] = None
+    context_rows: typing.Optional[int] = None
+    path: model.AnswerPath = model.AnswerPath.LLM
+
+async def generate_answer(question: str, data: list[dict], on_token: typing.Optional[TokenCallback] = None,
+                          template: typing.Optional[str] = None, truncated: bool = False,
+                          language: typing.Optional[model.Language] = None,
+                          answer_language: model.Language = model.Language.en_US) -> Answer:
+    rendered = render_answer(data, template=template, truncated=truncated, language=language,
+                             answer_language=answer_language)
+    if rendered is not None:
+        text, path = rendered
+        metrics.answer_paths.inc(path=path.value)
+        cprint("> Rendered answer without LLM", path=path.value, rows=len(data))
+        if on_token:
+            on_token(text)
+        return Answer(text, path=path)
+    metrics.answer_paths.inc(path=model.AnswerPath.LLM.value)
     answer_chain = CYPHER_QA_PROMPT | chat_model
-    async with driver.session() as session:
-        query = await generate_query_from_sample(session, question, output.queries, result_limit=result_limit)
+    context = build_context(data)
+    prompt_tokens = count_tokens(CYPHER_QA_PROMPT.format(question=question, context=context.text))
+    metrics.prompt_tokens.observe(prompt_tokens, part='prompt')
+    metrics.prompt_tokens.observe(context.tokens, part='context')
+    cprint("> Built answer context", rows=context.rows, omitted=context.omitted, context_tokens=context.tokens,
+           prompt_tokens=prompt_tokens)
+    inputs = {'question': question, 'context': context.text}
+    with metrics.timer('answer'):
+        if on_token is None:
+            answer: BaseMessage = await scheduler.ainvoke(answer_chain, inputs)
+            return Answer(answer.content, prompt_tokens, context.rows)
+        parts = []
+        async for chunk in scheduler.astream(answer_chain, inputs):
+            if chunk.content:
+                parts.append(chunk.content)
+                on_token(chunk.content)
+        return Answer(''.join(parts), prompt_tokens, context.rows)
+
+async def fetch_output(output: SearchOutput, question: str, driver: neo4j.AsyncDriver, result_limit: int = 20,
+                       on_token: typing.Optional[TokenCallback] = None,
+                       entities: typing.Optional[list[Entity]] = None):
+    parameters = {}
+    query = None
+    template = template_sample(output.queries)
+    if template is not None:
+        # the stored query runs as written, the corrector is not needed
+        filled = await fill_parameters(question, template, entities=entities)
+        if filled is None:
+            # values the question does not provide, run with the declared defaults or generate a query
+            filled = default_parameters(template)
+            fallback = 'defaults' if filled is not None else 'generation'
+            metrics.parameter_fallbacks.inc(to=fallback)
+            cprint("> Unable to fill query parameters", color='red', query=template.query, fallback=fallback)
+        if filled is not None:
+            parameters = filled
+            with metrics.timer('limit_enforcement'):
+                query = cypher.enforce_limit(template.query, result_limit=result_limit)
+            if 'result_limit' in cypher.parameters(query):
+                parameters = dict(parameters, result_limit=result_limit)
+    if query is None:
+        async with driver.session() as session:
+            query = await generate_query_from_sample(session, question, output.queries, result_limit=result_limit,
+                                                     entities=entities)
     if not query:
         return None
     
-    async with driver.session() as session:
-        async def run(txn: neo4j.AsyncTransaction):
-            return await (await txn.run(query)).data()
-        data = await session.execute_read(run)
+    executed = await execute_query(driver, query, parameters)
+    data = executed.data
     if not data:
         return None 
     visualization = output.visualization
-    result = {"queries": [{"query": query, "result": jsonify_result(data, indent=4)}],
-              'visualization': visualization, 'order': output.order}
+    result = {"queries": [{"query": query, "result": executed.text,
+                           "parameters": jsonify_result(parameters) if parameters else None,
+                           "rows": executed.rows, "bytes": executed.bytes, "truncated": executed.truncated}],
+              'visualization': visualization, 'order': output.order, 'truncated': executed.truncated}
     if visualization == model.VisualizationType.TEXT_ANSWER:
-        answer: BaseMessage = await answer_chain.ainvoke({'question': question, 'context': jsonify_result(data)})
-        snippet = answer.content
-        result['data'] = [{'answer': snippet}]
+        # the closest stored question tells which language the user asked in
+        language = max(output.queries, key=lambda q: q.score).language
+        answer = await generate_answer(question, data, on_token=on_token, template=output.answer_template,
+                                       truncated=executed.truncated, language=language,
+                                       answer_language=output.answer_language)
+        result['queries'][0].update(prompt_tokens=answer.prompt_tokens, context_rows=answer.context_rows)
+        result['answer_path'] = answer.path
+        result['data'] = [{'answer': answer.text}]
         result['fields'] = ['answer']
     elif visualization == model.VisualizationType.TABLE:
         result['data'] = data
@@ -211,59 +455,94 @@ async def fetch_output(output: SearchOutput, question: str, driver: neo4j.AsyncD
     result['data'] = result['data'] or []
     return model.SearchResultItem(**result)
    
-async def answer_question(question: str, 
-                           driver: neo4j.AsyncDriver,
-                           embedding: typing.Optional[list[float]] = None, result_limit: int = 20,
-                           ) -> list[model.SearchResultItem]:
-    
-    cprint(f"> Answering question: '{question}'", bold=True)
+async def stream_answers(question: str,
+                         driver: neo4j.AsyncDriver,
+                         embedding: typing.Optional[list[float]] = None, result_limit: int = 20,
+                         on_token: typing.Optional[typing.Callable[[int, str], None]] = None,
+                         outputs: typing.Optional[list[SearchOutput]] = None,
+                         entities: typing.Optional[list[Entity]] = None,
+                         ) -> typing.AsyncIterator[tuple[int, typing.Optional[model.SearchResultItem]]]:
+    """Yield (output index, result) pairs in completion order, outputs may be looked up in advance"""
+    cprint("> Answering question", question=question)
     if embedding is None:
-        cprint("> Entering embedding calculation", bold=True)
-        embedding = await embeddings_model.aembed_query(question)
-        cprint("> Embedding done", bold=True)
+        with metrics.timer('embedding'):
+            embedding = await embed_query(question)
 
-    async with driver.session() as session:
-        outputs = await find_queries(session, embedding)
+    async def _entities():
+        if entities is not None:
+            return entities
+        async with driver.session() as session:
+            return await entity.resolve_entities(session, question)
 
-    result_promises = [fetch_output(o, question, driver, result_limit=result_limit) for o in outputs]
+    if outputs is None:
+        async with driver.session() as session:
+            outputs, entities = await asyncio.gather(find_queries(session, embedding), _entities())
+    else:
+        entities = await _entities()
+
+    def _fetch(i: int, output: SearchOutput):
+        return fetch_output(output, question, driver, result_limit=result_limit,
+                            on_token=functools.partial(on_token, i) if on_token else None,
+                            entities=entities)
 
     if settings.DEBUG:
-        result: list[model.SearchResultItem] = [await p for p in result_promises]
-    else:
-        result: list[model.SearchResultItem] = await asyncio.gather(*result_promises)
+        for i, o in enumerate(outputs):
+            yield i, await _fetch(i, o)
+        return
+
+    async def _indexed(i: int, output: SearchOutput):
+        return i, await _fetch(i, output)
 
+    tasks = [asyncio.ensure_future(_indexed(i, o)) for i, o in enumerate(outputs)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def answer_question(question: str, 
+                           driver: neo4j.AsyncDriver,
+                           embedding: typing.Optional[list[float]] = None, result_limit: int = 20,
+                           ) -> list[model.SearchResultItem]:
+    result = [r async for _, r in stream_answers(question, driver, embedding=embedding, result_limit=result_limit)]
+    result = [r for r in result if r]
     if not result:
-        cprint("> No results found", bold=True, color="red")
+        cprint("> No results found", color="red", question=question)
     else:
-        cprint("Found %s results" % len(result), bold=True, color="green")
-    return sorted([r for r in result if r], key=lambda r: r.order)
+        cprint("> Found results", question=question, results=len(result))
+    return sorted(result, key=lambda r: r.order)
 
-async def default_search(question: str, driver: neo4j.AsyncDriver, result_limit:int = 20) -> list[model.SearchResultItem]:
+async def default_search(question: str, driver: neo4j.AsyncDriver, result_limit:int = 20,
+                         on_token: typing.Optional[TokenCallback] = None) -> list[model.SearchResultItem]:
     generator_chain = CYPHER_GENERATION_PROMPT | chat_model
-    cprint(f"> Generating answer to '{question}' using default strategy", bold=True)
-    query_msg: BaseMessage = await generator_chain.ainvoke({'question': question, 'schema': construct_schema(Neo4jGraph().get_structured_schema, [], [])})
+    cprint("> Generating answer using default strategy", question=question)
+    schema = await schema_provider.get(driver)
+    with metrics.timer('generation'):
+        query_msg: BaseMessage = await scheduler.ainvoke(generator_chain, {'question': question, 'schema': schema})
     query = query_msg.content
-    query = await enforce_limit(query, result_limit=result_limit)
+    with metrics.timer('limit_enforcement'):
+        query = cypher.enforce_limit(query, result_limit=result_limit)
     async with driver.session() as session:
         query_corrector = QueryCorrector(session)
         query = await query_corrector(query)
-    cprint(f"> Generated query:", bold=True)
-    cprint(query, color='yellow')
+    cprint("> Generated query", query=query)
     if not query:
         return []
-    async with driver.session() as session:
-        async def run(txn: neo4j.AsyncTransaction):
-            return await (await txn.run(query)).data()
-        data = await session.execute_read(run)
+    executed = await execute_query(driver, query)
+    data = executed.data
     if not data:
         return []
-    answer_chain = CYPHER_QA_PROMPT | chat_model
-    answer: BaseMessage = await answer_chain.ainvoke({'question': question, 'context': jsonify_result(data)})
-    snippet = answer.content
+    answer = await generate_answer(question, data, on_token=on_token, truncated=executed.truncated)
     return [
         model.SearchResultItem(
-            data=[{'answer': snippet}], 
-            queries=[model.SearchQueryMeta(query=query, result=jsonify_result(data))], 
+            data=[{'answer': answer.text}], 
+            queries=[model.SearchQueryMeta(query=query, result=executed.text, rows=executed.rows,
+                                           bytes=executed.bytes, truncated=executed.truncated,
+                                           prompt_tokens=answer.prompt_tokens,
+                                           context_rows=answer.context_rows)], 
             visualization=model.VisualizationType.TEXT_ANSWER,
-            fields=['answer'])
+            fields=['answer'],
+            truncated=executed.truncated,
+            answer_path=answer.path)
     ]
\ No newline at end of file
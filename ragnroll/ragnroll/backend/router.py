@@ -2,9 +2,13 @@ import fastapi
 import yaml.parser
 
 from . import model
+from . import db
+from . import schema
+from . import vector
+from . import context
 from .langchain import chat_model
 import neo4j.exceptions
-from .util import extract_model
+from .util import extract_model, setup_logging
 import asyncio
 import neo4j.spatial
 import neo4j.time
@@ -25,6 +29,11 @@ router = fastapi.APIRouter(route_class=YamlRoute, responses={422: {
 }})
 
 reflex_app.api.title = "RAG'n'Roll"
+reflex_app.register_lifespan_task(setup_logging)
+reflex_app.register_lifespan_task(db.lifespan)
+reflex_app.register_lifespan_task(schema.warm)
+reflex_app.register_lifespan_task(vector.warm)
+reflex_app.register_lifespan_task(context.warm)
 
 @router.post("/chat/completions", response_model_exclude_none=True, response_model_exclude_unset=True)
 async def chat():
@@ -0,0 +1,163 @@
+from . import settings
+from . import metrics
+import asyncio
+import collections
+import contextlib
+import contextvars
+import enum
+import time
+import typing
+
+from langchain_core.runnables.base import Runnable
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+tenant: contextvars.ContextVar[str] = contextvars.ContextVar('llm_tenant', default='default')
+priority: contextvars.ContextVar[Priority] = contextvars.ContextVar('llm_priority', default=Priority.INTERACTIVE)
+
+
+class TokenBucket(object):
+
+    def __init__(self, tokens_per_minute: int) -> None:
+        self.rate = tokens_per_minute / 60.0
+        self.capacity = float(tokens_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: int) -> float:
+        """Consume cost tokens, or return how long to wait before retrying"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class Scheduler(object):
+    """Bounds in-flight LLM calls, serving priorities in order and tenants round-robin"""
+
+    def __init__(self, max_concurrency: int, tokens_per_minute: typing.Optional[int] = None) -> None:
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.active = 0
+        self.queues: dict[Priority, collections.OrderedDict[str, collections.deque[tuple[asyncio.Future, int]]]] = {
+            p: collections.OrderedDict() for p in Priority
+        }
+        self.timer: typing.Optional[asyncio.TimerHandle] = None
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def queued(self) -> int:
+        return sum(len(w) for q in self.queues.values() for w in q.values())
+
+    def _head(self) -> typing.Optional[tuple[collections.OrderedDict, str]]:
+        """Queue and tenant of the next pending waiter, dropping cancelled ones on the way"""
+        for p in Priority:
+            queue = self.queues[p]
+            while queue:
+                name, waiters = next(iter(queue.items()))
+                while waiters and waiters[0][0].done():
+                    waiters.popleft()
+                if waiters:
+                    return queue, name
+                del queue[name]
+        return None
+
+    def _retry_later(self, delay: float):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.max_concurrency:
+            head = self._head()
+            if head is None:
+                return
+            queue, name = head
+            waiters = queue[name]
+            waiter, cost = waiters[0]
+            if self.bucket is not None and (delay := self.bucket.take(cost)) > 0:
+                # the head waits for tokens without holding a slot, everything behind it keeps its place
+                self._retry_later(delay)
+                return
+            waiters.popleft()
+            if waiters:
+                queue.move_to_end(name)
+            else:
+                del queue[name]
+            self.active += 1
+            waiter.set_result(None)
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cost: int = 0):
+        waiter = asyncio.get_running_loop().create_future()
+        level = priority.get()
+        self.queues[level].setdefault(tenant.get(), collections.deque()).append((waiter, cost))
+        start = time.monotonic()
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+        try:
+            waited = time.monotonic() - start
+            self.waits += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            metrics.llm_queue_wait.observe(waited, priority=level.name.lower())
+            yield
+        finally:
+            self._release()
+
+    @contextlib.asynccontextmanager
+    async def call(self, kind: str, cost: int = 0):
+        """Take a slot and count the call, and its failure, under kind"""
+        async with self.slot(cost):
+            metrics.llm_calls.inc(kind=kind)
+            try:
+                yield
+            except Exception:
+                metrics.llm_errors.inc(kind=kind)
+                raise
+
+    def stats(self) -> dict:
+        return {'active': self.active, 'queued': self.queued(), 'max_concurrency': self.max_concurrency,
+                'waits': self.waits, 'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max}
+
+
+llm_scheduler = Scheduler(max_concurrency=settings.LLM_MAX_CONCURRENCY,
+                          tokens_per_minute=settings.LLM_TOKENS_PER_MINUTE)
+
+
+def estimate_tokens(value: typing.Any) -> int:
+    return len(str(value)) // 4 + 1
+
+
+async def ainvoke(chain: Runnable, input: dict) -> typing.Any:
+    async with llm_scheduler.call('chat', estimate_tokens(input) + settings.LLM_COMPLETION_TOKEN_ESTIMATE):
+        return await chain.ainvoke(input)
+
+
+async def astream(chain: Runnable, input: dict) -> typing.AsyncIterator[typing.Any]:
+    async with llm_scheduler.call('chat', estimate_tokens(input) + settings.LLM_COMPLETION_TOKEN_ESTIMATE):
+        async for chunk in chain.astream(input):
+            yield chunk
@@ -0,0 +1,126 @@
+from . import settings
+from . import db
+from . import cache
+from . import metrics
+from .util import cprint
+from langchain_community.chains.graph_qa.cypher import construct_schema
+import asyncio
+import neo4j
+import time
+import typing
+
+# the expertise graph written by ingest is bookkeeping, not data the generated queries should target
+RAG_LABELS = ['_RAGExpertise', '_RAGPattern', '_RAGQuestion', '_RAGOutput', '_RAGQuery']
+EXCLUDED_LABELS = ['_Bloom_Perspective_', '_Bloom_Scene_', '__Entity__'] + RAG_LABELS
+EXCLUDED_RELS = ['_Bloom_HAS_SCENE_']
+
+NODE_PROPERTIES_QUERY = '''
+    CALL apoc.meta.data()
+    YIELD label, other, elementType, type, property
+    WHERE NOT type = "RELATIONSHIP" AND elementType = "node"
+      AND NOT label IN $excluded
+    WITH label AS nodeLabels, collect({property:property, type:type}) AS properties
+    RETURN {labels: nodeLabels, properties: properties} AS output
+'''
+
+REL_PROPERTIES_QUERY = '''
+    CALL apoc.meta.data()
+    YIELD label, other, elementType, type, property
+    WHERE NOT type = "RELATIONSHIP" AND elementType = "relationship"
+      AND NOT label IN $excluded
+    WITH label AS nodeLabels, collect({property:property, type:type}) AS properties
+    RETURN {type: nodeLabels, properties: properties} AS output
+'''
+
+REL_QUERY = '''
+    CALL apoc.meta.data()
+    YIELD label, other, elementType, type, property
+    WHERE type = "RELATIONSHIP" AND elementType = "node"
+    UNWIND other AS other_node
+    WITH * WHERE NOT label IN $excluded
+        AND NOT other_node IN $excluded
+    RETURN {start: label, type: property, end: toString(other_node)} AS output
+'''
+
+
+class SchemaProvider(object):
+    """Caches the rendered graph schema used by the fallback query generator"""
+
+    def __init__(self, refresh_interval: float = 600.0) -> None:
+        self.refresh_interval = refresh_interval
+        self.schema: typing.Optional[str] = None
+        self.loaded_at = 0.0
+        self.lock = asyncio.Lock()
+        self.task: typing.Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.last_duration = 0.0
+
+    async def introspect(self, driver: neo4j.AsyncDriver) -> dict:
+        async def _job(txn: neo4j.AsyncTransaction):
+            async def fetch(query: str, excluded: list[str]) -> list[dict]:
+                result = await txn.run(query, parameters={'excluded': excluded})
+                return [r['output'] for r in await result.data()]
+            return (await fetch(NODE_PROPERTIES_QUERY, EXCLUDED_LABELS),
+                    await fetch(REL_PROPERTIES_QUERY, EXCLUDED_RELS),
+                    await fetch(REL_QUERY, EXCLUDED_LABELS))
+
+        async with driver.session() as session:
+            node_props, rel_props, relationships = await session.execute_read(db.bounded(_job))
+        return {
+            'node_props': {el['labels']: el['properties'] for el in node_props},
+            'rel_props': {el['type']: el['properties'] for el in rel_props},
+            'relationships': relationships,
+        }
+
+    async def refresh(self, driver: neo4j.AsyncDriver) -> str:
+        async with self.lock:
+            start = time.perf_counter()
+            with metrics.timer('schema_introspection'):
+                schema = construct_schema(await self.introspect(driver), [], [])
+            self.last_duration = time.perf_counter() - start
+            self.refreshes += 1
+            cprint("> Schema introspected", seconds=round(self.last_duration, 3))
+            if schema != self.schema:
+                cache.schema_changed()
+            self.schema = schema
+            self.loaded_at = time.monotonic()
+            return schema
+
+    def _refresh_in_background(self, driver: neo4j.AsyncDriver):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.refresh(driver))
+
+    async def get(self, driver: neo4j.AsyncDriver) -> str:
+        if self.schema is None:
+            self.misses += 1
+            if self.lock.locked():
+                async with self.lock:
+                    pass
+                if self.schema is not None:
+                    return self.schema
+            return await self.refresh(driver)
+        self.hits += 1
+        if time.monotonic() - self.loaded_at > self.refresh_interval:
+            # serve the stale schema while a single refresh runs
+            self._refresh_in_background(driver)
+        return self.schema
+
+    def stats(self) -> dict:
+        return {'size': int(self.schema is not None), 'maxsize': 1,
+                'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes,
+                'introspection_seconds': self.last_duration}
+
+
+schema_provider = SchemaProvider(refresh_interval=settings.SCHEMA_REFRESH_INTERVAL)
+
+
+async def warm():
+    if not settings.ALLOW_FALLBACK:
+        return
+    try:
+        async with db.borrow(None) as driver:
+            await schema_provider.refresh(driver)
+    except Exception as e:
+        cprint("> Unable to warm schema cache", color='red', error=str(e))
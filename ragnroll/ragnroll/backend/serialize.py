@@ -0,0 +1,37 @@
+import typing
+import orjson
+import neo4j.graph
+import neo4j.spatial
+import neo4j.time
+
+
+def default(obj: typing.Any) -> typing.Any:
+    """Encode Neo4j values orjson does not know, nested values are passed back through the encoder"""
+    if isinstance(obj, (neo4j.time.Date, neo4j.time.Time, neo4j.time.DateTime, neo4j.time.Duration)):
+        return obj.iso_format()
+    elif isinstance(obj, neo4j.spatial.Point):
+        return {'srid': obj.srid, 'coordinates': list(obj)}
+    elif isinstance(obj, neo4j.graph.Node):
+        return {'id': obj.element_id, 'labels': sorted(obj.labels), 'properties': dict(obj)}
+    elif isinstance(obj, neo4j.graph.Relationship):
+        return {'id': obj.element_id, 'type': obj.type,
+                'start': obj.start_node.element_id if obj.start_node else None,
+                'end': obj.end_node.element_id if obj.end_node else None,
+                'properties': dict(obj)}
+    elif isinstance(obj, neo4j.graph.Path):
+        return {'nodes': list(obj.nodes), 'relationships': list(obj.relationships)}
+    elif isinstance(obj, (bytes, bytearray)):
+        return obj.hex()
+    elif isinstance(obj, (tuple, set, frozenset)):
+        return list(obj)
+    raise TypeError(f'Type is not JSON serializable: {type(obj).__name__}')
+
+
+def dumps(data: typing.Any, pretty: bool = False) -> bytes:
+    return orjson.dumps(data, default=default, option=orjson.OPT_INDENT_2 if pretty else 0)
+
+
+def dumps_rows(rows: list[bytes]) -> bytes:
+    """Join rows encoded one by one into the encoded list, without encoding them again"""
+    return b'[' + b','.join(rows) + b']'
+
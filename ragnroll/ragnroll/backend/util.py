@@ -1,19 +1,73 @@
-from langchain_core.utils.input import get_colored_text, print_text, get_bolded_text
+from . import settings
+import atexit
+import copy
+import logging
+import logging.handlers
+import queue
+import time
 import typing
 import fastapi
 import json 
 import pydantic
 import yaml
 
-def format_text(text, *, color=None, bold=False):
-    if color:
-        text = get_colored_text(text, color)
-    if bold:
-        text = get_bolded_text(text)
-    return text
+class StructuredFormatter(logging.Formatter):
+    """Render records as logfmt style text or JSON lines, including any `fields` passed in extra"""
 
-def cprint(text, *, color=None, bold=False):
-    print(format_text(text, color=color, bold=bold))
+    def __init__(self, style: str = 'text') -> None:
+        super().__init__()
+        self.output = style
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.%03dZ' % record.msecs,
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        if self.output == 'json':
+            return json.dumps(entry, default=str)
+        return ' '.join(f'{k}={json.dumps(v, default=str) if isinstance(v, str) and (" " in v or not v) else v}'
+                        for k, v in entry.items())
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queue records with exc_info intact, the listener's formatter renders it as the `exc` field"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+log = logging.getLogger('ragnroll.backend')
+listener: typing.Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging():
+    """Route backend logs through a listener thread, called once at startup"""
+    global listener
+    if listener is not None:
+        return
+    # records are queued on the event loop thread and written by the listener thread
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(settings.LOG_FORMAT))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    log.addHandler(RecordQueueHandler(records))
+    log.setLevel(settings.LOG_LEVEL.upper())
+    log.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def cprint(text, *, color=None, bold=False, **fields):
+    # color and bold are kept for call-site compatibility, red marks a warning
+    log.log(logging.WARNING if color == 'red' else logging.INFO, text, extra={'fields': fields})
 
 S = typing.TypeVar('S', bound=pydantic.BaseModel)
 
@@ -0,0 +1,121 @@
+from . import settings
+from . import cache
+from . import db
+from . import metrics
+from .util import cprint
+import asyncio
+import time
+import typing
+import neo4j
+import numpy
+
+LOAD_QUERY = '''
+    MATCH (k:_RAGQuestion)
+    WHERE k.embedding IS NOT NULL
+    RETURN elementId(k) AS id, k.embedding AS embedding
+'''
+
+FETCH_QUERY = '''
+    UNWIND $matches AS match
+    MATCH (node:_RAGQuestion)
+    WHERE elementId(node) = match.id
+    MATCH (query:_RAGQuery)-[:ANSWERS]-(node)
+    MATCH (query)-[HAS_OUTPUT]-(output:_RAGOutput)
+    RETURN distinct match.index AS i, query, node as question, output, match.score AS score
+'''
+
+
+class QuestionIndex(object):
+    """In-process mirror of _RAGQuestion embeddings as a contiguous float32 matrix of unit rows"""
+
+    def __init__(self, refresh_interval: float = 300.0) -> None:
+        self.refresh_interval = refresh_interval
+        self.ids: list[str] = []
+        self.matrix = numpy.zeros((0, 0), dtype=numpy.float32)
+        self.version: typing.Optional[int] = None
+        self.loaded_at = 0.0
+        self.lock = asyncio.Lock()
+        self.searches = 0
+        self.loads = 0
+        self.last_duration = 0.0
+
+    def build(self, rows: list[tuple[str, list[float]]]):
+        self.ids = [r[0] for r in rows]
+        matrix = numpy.array([r[1] for r in rows], dtype=numpy.float32)
+        if len(rows):
+            matrix /= numpy.maximum(numpy.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        self.matrix = numpy.ascontiguousarray(matrix)
+
+    async def load(self, session: neo4j.AsyncSession):
+        # capture the version first, an upload racing the load triggers another one
+        version = cache.expertise_version
+        start = time.perf_counter()
+
+        async def _job(txn: neo4j.AsyncTransaction):
+            result = await txn.run(LOAD_QUERY)
+            return [(r['id'], r['embedding']) async for r in result]
+
+        rows = await session.execute_read(db.bounded(_job))
+        self.build(rows)
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.loads += 1
+        self.last_duration = time.perf_counter() - start
+        cprint("> Loaded question vector index", questions=len(self.ids), seconds=round(self.last_duration, 3))
+
+    def stale(self) -> bool:
+        return self.version != cache.expertise_version or \
+            time.monotonic() - self.loaded_at > self.refresh_interval
+
+    async def ensure(self, session: neo4j.AsyncSession):
+        if not self.stale():
+            return
+        async with self.lock:
+            if self.stale():
+                await self.load(session)
+
+    def search(self, embedding: list[float], count: int, min_score: float) -> list[dict]:
+        """Top count matches above min_score, scored like the Neo4j cosine index"""
+        self.searches += 1
+        if not self.ids:
+            return []
+        query = numpy.asarray(embedding, dtype=numpy.float32)
+        query = query / max(float(numpy.linalg.norm(query)), 1e-12)
+        scores = (1.0 + self.matrix @ query) / 2.0
+        count = min(count, len(self.ids))
+        top = numpy.argpartition(-scores, count - 1)[:count]
+        top = top[numpy.argsort(-scores[top])]
+        return [{'id': self.ids[i], 'score': float(scores[i])} for i in top if scores[i] > min_score]
+
+    async def query(self, session: neo4j.AsyncSession, embeddings: list[list[float]],
+                    count: int, min_score: float) -> list[dict]:
+        """Rows for the matches of every embedding, tagged with the embedding index as i"""
+        await self.ensure(session)
+        with metrics.timer('vector_search'):
+            matches = [dict(m, index=i) for i, embedding in enumerate(embeddings)
+                       for m in self.search(embedding, count, min_score)]
+        if not matches:
+            return []
+
+        async def _job(txn: neo4j.AsyncTransaction):
+            return await (await txn.run(FETCH_QUERY, parameters={'matches': matches})).data()
+
+        return await session.execute_read(db.bounded(_job))
+
+    def stats(self) -> dict:
+        return {'size': len(self.ids), 'maxsize': len(self.ids), 'hits': self.searches, 'misses': self.loads,
+                'version': self.version, 'load_seconds': self.last_duration}
+
+
+question_index = QuestionIndex(refresh_interval=settings.VECTOR_INDEX_REFRESH_INTERVAL)
+
+
+async def warm():
+    if settings.VECTOR_INDEX != 'local':
+        return
+    try:
+        async with db.borrow(None) as driver:
+            async with driver.session() as session:
+                await question_index.load(session)
+    except Exception as e:
+        cprint("> Unable to load question vector index", color='red', error=str(e))
@@ -19,7 +19,7 @@ def render_snippet(item: state.SearchResultItem):
 
 def wrap_search(component: rx.Component) -> rx.Component:
     return rx.cond(
-        State.searching,
+        State.waiting,
         rx.flex(
             rx.center(
                 rxchakra.spinner(size='xl'),
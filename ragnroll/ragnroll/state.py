@@ -3,6 +3,8 @@ import httpx
 from rxconfig import config
 import typing
 import asyncio
+import json
+import time
 
 class SearchResultItem(rx.Base):
     data: list[dict[str, typing.Any]]
@@ -12,6 +14,13 @@ class SearchResultItem(rx.Base):
     axes: dict[str, str] = {}
  
 
+def display_item(item: dict) -> SearchResultItem:
+    # the API returns compact query results, indent them only for the results shown
+    queries = [dict(q, result=json.dumps(json.loads(q['result']), indent=4)) if q.get('result') else q
+               for q in item.get('queries', [])]
+    return SearchResultItem(**dict(item, queries=queries))
+
+
 class State(rx.State):
     """The app state."""
     
@@ -22,6 +31,10 @@ class State(rx.State):
 
     code: str = ''
 
+    @rx.var
+    def waiting(self) -> bool:
+        return self.searching and not self.search_results
+
     async def handle_submit(self, form_data: dict):
         if self.searching:
             return 
@@ -30,15 +43,57 @@ class State(rx.State):
         self.alert_message = None
         self.searching = True
         yield
+        self.search_results = []
         try:
+            positions: dict[int, int] = {}
+            last_update = time.monotonic()
             async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.get(f'{config.api_url}/search', params={'question': form_data['question']})
-                data = response.json()
-            self.search_results = [SearchResultItem(**d) for d in data['data']]
+                async with client.stream('GET', f'{config.api_url}/search/stream',
+                                         params={'question': form_data['question']}) as response:
+                    if not response.is_success:
+                        # error responses are a plain JSON body, not an event stream
+                        await response.aread()
+                        self.alert_message = f"Backend error ({response.status_code})"
+                        return
+                    async for line in response.aiter_lines():
+                        if not line.strip():
+                            continue
+                        event = json.loads(line)
+                        index = event.get('index', None)
+                        kind = event.get('event', None)
+                        if kind == 'token':
+                            if index not in positions:
+                                positions[index] = len(self.search_results)
+                                self.search_results = self.search_results + [SearchResultItem(
+                                    data=[{'answer': ''}], queries=[], fields=['answer'], visualization='text-answer')]
+                            results = list(self.search_results)
+                            item = results[positions[index]]
+                            results[positions[index]] = item.copy(update={'data': [{'answer': item.data[0]['answer'] + event['delta']}]})
+                            self.search_results = results
+                            # coalesce token updates to keep the websocket traffic bounded
+                            if time.monotonic() - last_update > 0.05:
+                                last_update = time.monotonic()
+                                yield
+                        elif kind == 'result':
+                            results = list(self.search_results)
+                            if index in positions:
+                                results[positions[index]] = display_item(event['item'])
+                            else:
+                                positions[index] = len(results)
+                                results.append(display_item(event['item']))
+                            self.search_results = results
+                            yield
+                        elif kind == 'done':
+                            self.search_results = [self.search_results[positions[i]] for i in event['order']]
         except httpx.ReadTimeout:
             self.alert_message = "Backend timeout"
         except httpx.ConnectError:
             self.alert_message = "Unable to connect to backend"
+        except httpx.HTTPError:
+            # the connection dropped or broke mid-stream
+            self.alert_message = "Backend connection lost"
+        except json.JSONDecodeError:
+            self.alert_message = "Invalid response from backend"
         finally:
             self.searching=False
             yield
@@ -0,0 +1,11 @@
+import os
+
+# settings are read when ragnroll.backend is first imported, tests never reach these services
+for name, value in {
+    'NEO4J_URI': 'bolt://localhost:7687',
+    'NEO4J_DATABASE': 'neo4j',
+    'NEO4J_USERNAME': 'neo4j',
+    'NEO4J_PASSWORD': 'offline',
+    'OPENAI_API_KEY': 'offline',
+}.items():
+    os.environ.setdefault(name, value)
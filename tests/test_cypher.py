@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from ragnroll.backend import cypher
+from benchmarks.bench import random_query
+
+RESULT_LIMIT = 20
+
+LIMIT_CORPUS = [
+    ('MATCH (n) RETURN n', 'MATCH (n) RETURN n LIMIT 20'),
+    ('MATCH (n) RETURN n LIMIT 100;', 'MATCH (n) RETURN n LIMIT 20'),
+    ('MATCH (n) RETURN n limit 5', 'MATCH (n) RETURN n limit 5'),
+    ('MATCH (n) RETURN n LIMIT 5.0', 'MATCH (n) RETURN n LIMIT 5'),
+    ('MATCH (n) RETURN n LIMIT 010', 'MATCH (n) RETURN n LIMIT 10'),
+    ('MATCH (n) RETURN n SKIP 5 LIMIT $limit', 'MATCH (n) RETURN n SKIP 5 LIMIT 20'),
+    ('MATCH (n) WITH n LIMIT 500 RETURN n', 'MATCH (n) WITH n LIMIT 500 RETURN n LIMIT 20'),
+    ('CALL { MATCH (n) RETURN n LIMIT 1000 } RETURN n', 'CALL { MATCH (n) RETURN n LIMIT 1000 } RETURN n LIMIT 20'),
+    ("MATCH (n {name: 'x LIMIT 500'}) RETURN n.limit AS limit ORDER BY n.x // LIMIT 1000",
+     "MATCH (n {name: 'x LIMIT 500'}) RETURN n.limit AS limit ORDER BY n.x LIMIT 20 // LIMIT 1000"),
+    ('MATCH (n) RETURN n LIMIT 50 UNION ALL MATCH (m) RETURN m AS n',
+     'MATCH (n) RETURN n LIMIT 20 UNION ALL MATCH (m) RETURN m AS n LIMIT 20'),
+    ('CALL db.labels()', 'CALL db.labels()'),
+]
+
+
+@pytest.mark.parametrize('query,expected', LIMIT_CORPUS)
+def test_enforce_limit_corpus(query, expected):
+    assert cypher.enforce_limit(query, RESULT_LIMIT) == expected
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_enforce_limit_properties(seed):
+    rnd = random.Random(seed)
+    for _ in range(100):
+        query = random_query(rnd)
+        result = cypher.enforce_limit(query, RESULT_LIMIT)
+        assert cypher.enforce_limit(result, RESULT_LIMIT) == result, 'not idempotent'
+        for token in cypher.tokenize(query):
+            if token.kind in ('string', 'comment'):
+                assert token.text in result, 'literal altered'
+        for branch in cypher.branches(cypher.significant(cypher.tokenize(result))):
+            returns = [i for i in range(len(branch)) if cypher.is_clause(branch, i, 'RETURN')]
+            limits = [i for i in range(returns[-1], len(branch)) if cypher.is_clause(branch, i, 'LIMIT')]
+            assert limits and limits[-1] + 2 == len(branch), 'missing final limit'
+            assert branch[-1].text == str(int(branch[-1].text)), 'limit is not an integer literal'
+            assert int(branch[-1].text) <= RESULT_LIMIT, 'limit not clamped'